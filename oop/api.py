@@ -1,36 +1,58 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
+import errno
+import functools
 import logging
 import hashlib
+import hmac
+import multiprocessing
+import os
+import random
+import re
+import select
+import signal
+import socket
+import tempfile
+import threading
+import time
 import uuid
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from datetime import datetime
+from Queue import Queue
+from datetime import datetime, timedelta
 from optparse import OptionParser
 
 import six
 from dateutil.relativedelta import relativedelta
 
-from scoring import get_interests, get_score
-from store import Store
+import metrics
+import serialization
+from asynclog import setup_logging
+from jsonstream import ObjectScanner
+from scoring import get_interests, get_interests_many, get_score, get_scores
+from store import BACKENDS, LocalCache, TarantoolStore, request_deadline
 
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
+AUTH_CACHE_SIZE = 10000
 OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
 UNKNOWN = 0
 MALE = 1
@@ -43,6 +65,30 @@ GENDERS = {
 
 EMPTY_VALUES = (None, '', [], (), {})
 
+REQUESTS = metrics.Counter(
+    'http_requests_total', 'Served requests.', ('method', 'code'))
+REQUEST_LATENCY = metrics.Histogram(
+    'http_request_duration_seconds', 'Time of serving requests.',
+    ('method', 'code'))
+STAGE_LATENCY = metrics.Histogram(
+    'request_stage_duration_seconds', 'Time of request handling stages.',
+    ('stage',))
+VALIDATION = ('validation',)
+CHECK_AUTH = ('check_auth',)
+
+
+class ValidationError(Exception):
+    """An error while validating data."""
+    def __init__(self, message, code=None, params=None):
+        super(ValidationError, self).__init__(message, code, params)
+        self.message = message
+        self.code = code
+        self.params = params
+
+    @property
+    def error_list(self):
+        return [self]
+
 
 class Field(object):
     default_error_messages = {
@@ -59,6 +105,10 @@ class Field(object):
         for c in reversed(self.__class__.__mro__):
             messages.update(getattr(c, 'default_error_messages', {}))
         self.error_messages = messages
+        # Invalid values are common, so their errors are built once
+        self.validation_errors = dict(
+            (code, ValidationError(message))
+            for code, message in messages.items())
         super(Field, self).__init__()
 
     def prepare_value(self, value):
@@ -68,7 +118,7 @@ class Field(object):
     def validate(self, value):
         """ Basic validation """
         if value in self.empty_values and not self.nullable:
-            raise ValidationError(self.error_messages['nullable'])
+            raise self.validation_errors['nullable']
 
     def clean(self, value):
         """
@@ -81,66 +131,132 @@ class Field(object):
 
 
 class BaseRequest(object):
+    # Fields of a request are slots too, see DeclarativeFieldsMetaclass
+    __slots__ = ('data', '_errors')
     default_error_messages = {
         'required': 'This field <{}> is required.',
     }
 
     def __init__(self, data=None):
-        self._errors = {}
         self.data = {} if data is None else data
-        self.fields = []
-        self.not_empty_fields = []
-        for key, value in self.base_fields:
-            if key not in self.data:
-                setattr(self, key, '')
-                continue
-            setattr(self, key, self.data[key])
-            self.fields.append((key, value))
-
-            if self.data[key] not in EMPTY_VALUES:
-                self.not_empty_fields.append(key)
+        errors, missing = self._bind(self.data)
+        self._errors = errors
+        if missing is None:
+            try:
+                self.clean()
+            except ValidationError as e:
+                missing = e.message
+        if missing is not None:
+            if self._errors is None:
+                self._errors = {}
+            self._errors[self.__class__.__name__] = missing
 
     @property
     def errors(self):
         """Return errors for the data provided for the request."""
-        self._clean_request()
-        self._clean_fields()
-        return self._errors
+        return {} if self._errors is None else self._errors
+
+    @property
+    def fields(self):
+        return [(key, field) for key, field in self.base_fields
+                if key in self.data]
+
+    @property
+    def not_empty_fields(self):
+        return [key for key, field in self.base_fields
+                if self.data.get(key) not in EMPTY_VALUES]
 
     def is_valid(self):
         """Return True if the request has no errors, or False otherwise."""
-        return not self.errors
-
-    def _validate(self):
-        """ Basic validation for required fields """
-        for field in self.base_fields:
-            if field[1].required and field not in self.fields:
-                raise ValidationError(
-                    self.default_error_messages['required'].format(field[0])
-                )
-
-    def _clean_fields(self):
-        for name, field in self.fields:
-            value = self.data.get(name)
-            try:
-                field.clean(value)
-            except ValidationError as e:
-                self._errors[name] = e.message
-
-    def _clean_request(self):
-        try:
-            self._validate()
-            self.clean()
-        except ValidationError as e:
-            self._errors[self.__class__.__name__] = e.message
+        return self._errors is None
 
     def clean(self):
         """ Implemented in a request """
         pass
 
 
+BIND_TEMPLATE = """
+def bind(self, data):
+    errors = None
+    missing = None
+{fields}
+    return errors, missing
+"""
+
+BIND_FIELD_TEMPLATE = """
+    if {name!r} in data:
+        value = self.{name} = data[{name!r}]
+        if value in EMPTY_VALUES:
+{empty}
+        else:
+            try:
+                value = prepare_{name}(value)
+            except ValidationError as e:
+                if errors is None:
+                    errors = {{}}
+                errors[{name!r}] = e.message
+{nullable}
+    else:
+        self.{name} = ''
+{required}
+"""
+
+
+def compile_bind(base_fields, required_message):
+    """
+    Build a function which binds data to a request and validates all its
+    fields in one pass. It returns field errors (None if there are no
+    errors) and the message about the first missing required field.
+    """
+    namespace = {
+        'EMPTY_VALUES': EMPTY_VALUES,
+        'ValidationError': ValidationError,
+    }
+    fields = []
+    for name, field in base_fields:
+        namespace['prepare_' + name] = field.prepare_value
+        # Every field turns an empty value into an empty one,
+        # so the result for empty values is known beforehand.
+        try:
+            field.clean('')
+            empty = "            pass"
+        except ValidationError as e:
+            namespace['empty_' + name] = e.message
+            empty = (
+                "            if errors is None:\n"
+                "                errors = {{}}\n"
+                "            errors[{name!r}] = empty_{name}"
+            ).format(name=name)
+        nullable = ""
+        if not field.nullable:
+            namespace['nullable_' + name] = field.error_messages['nullable']
+            nullable = (
+                "            else:\n"
+                "                if value in EMPTY_VALUES:\n"
+                "                    if errors is None:\n"
+                "                        errors = {{}}\n"
+                "                    errors[{name!r}] = nullable_{name}"
+            ).format(name=name)
+        required = ""
+        if field.required:
+            namespace['required_' + name] = required_message.format(name)
+            required = (
+                "        if missing is None:\n"
+                "            missing = required_{name}"
+            ).format(name=name)
+        fields.append(BIND_FIELD_TEMPLATE.format(
+            name=name, empty=empty, nullable=nullable, required=required))
+
+    six.exec_(BIND_TEMPLATE.format(fields="".join(fields)), namespace)
+    return namespace['bind']
+
+
 class DeclarativeFieldsMetaclass(type):
-    """Collect Fields declared on the base classes."""
+    """
+    Collect Fields declared on the base classes and compile
+    a function which binds and validates them. Values of the fields
+    are kept in slots, so requests have no instance dict.
+    """
     def __new__(mcs, name, bases, attrs):
         # Collect fields from current class.
         base_fields = []
@@ -148,10 +264,14 @@ class DeclarativeFieldsMetaclass(type):
             if isinstance(value, Field):
                 base_fields.append((key, value))
                 attrs.pop(key)
+        attrs['__slots__'] = tuple(attrs.get('__slots__', ())) + tuple(
+            key for key, field in base_fields)
 
         new_class = super(DeclarativeFieldsMetaclass, mcs).\
             __new__(mcs, name, bases, attrs)
         new_class.base_fields = base_fields
+        new_class._bind = compile_bind(
+            base_fields, new_class.default_error_messages['required'])
 
         return new_class
 
@@ -160,16 +280,6 @@ class Request(six.with_metaclass(DeclarativeFieldsMetaclass, BaseRequest)):
     "A collection of Fields, plus their associated data."
 
 
-class ValidationError(Exception):
-    """An error while validating data."""
-    def __init__(self, message, code=None, params=None):
-        super(ValidationError, self).__init__(message, code, params)
-        self.message = message
-        self.code = code
-        self.params = params
-        self.error_list = [self]
-
-
 class CharField(Field):
     def __init__(self, empty_value='', **kwargs):
         self.empty_value = empty_value
@@ -182,6 +292,21 @@ class CharField(Field):
         return value
 
 
+DATE_RE = re.compile(r'(\d\d)\.(\d\d)\.(\d\d\d\d)\Z')
+
+
+def parse_date(value):
+    """
+    Parse a DD.MM.YYYY date. Dates with one digit day or month, which
+    strptime accepts too, are left to strptime.
+    """
+    match = DATE_RE.match(value)
+    if match is None:
+        return datetime.strptime(value, '%d.%m.%Y')
+    day, month, year = match.groups()
+    return datetime(int(year), int(month), int(day))
+
+
 class DateField(Field):
     default_error_messages = {
         'date_format': "Invalid date. Must be in format DD.MM.YYYY",
@@ -191,9 +316,9 @@ class DateField(Field):
         if value in self.empty_values:
             return ''
         try:
-            value = datetime.strptime(value, '%d.%m.%Y')
+            value = parse_date(value)
         except:
-            raise ValidationError(self.error_messages['date_format'])
+            raise self.validation_errors['date_format']
         return value
 
 
@@ -207,7 +332,7 @@ class ClientIDsField(Field):
             return None
         if not isinstance(value, list) or \
                 not all(isinstance(v, int) for v in value):
-            raise ValidationError(self.error_messages['list_int'])
+            raise self.validation_errors['list_int']
         return value
 
 
@@ -221,9 +346,9 @@ class PhoneField(Field):
         if value in self.empty_values:
             return ''
         if len(str(value)) != 11:
-            raise ValidationError(self.error_messages['length'])
+            raise self.validation_errors['length']
         if not str(value).startswith('7'):
-            raise ValidationError(self.error_messages['start_7'])
+            raise self.validation_errors['start_7']
         return value
 
 
@@ -236,10 +361,40 @@ class EmailField(CharField):
         if value in self.empty_values:
             return ''
         if "@" not in value:
-            raise ValidationError(self.error_messages['email'])
+            raise self.validation_errors['email']
         return value
 
 
+MAX_AGE = 70
+birthday_cutoff = (0, None)
+
+
+def get_birthday_cutoff(today):
+    """
+    Return the latest birthday of a person older than MAX_AGE full years
+    on the given day.
+    """
+    years = relativedelta(years=MAX_AGE + 1)
+    cutoff = today - years
+    # A birthday on February 29 turns into February 28
+    if cutoff + timedelta(days=1) + years <= today:
+        cutoff += timedelta(days=1)
+    return cutoff
+
+
+def birthday_cutoff_today():
+    """Return the birthday cutoff, it changes once a day."""
+    global birthday_cutoff
+    valid_till, cutoff = birthday_cutoff
+    if time.time() >= valid_till:
+        today = datetime.now().replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        cutoff = get_birthday_cutoff(today)
+        birthday_cutoff = (
+            time.mktime((today + timedelta(days=1)).timetuple()), cutoff)
+    return cutoff
+
+
 class BirthDayField(DateField):
     default_error_messages = {
         'birthday': "Invalid Birthday. Must be less then 70",
@@ -247,8 +402,8 @@ class BirthDayField(DateField):
 
     def prepare_value(self, value):
         new_value = super(BirthDayField, self).prepare_value(value)
-        if relativedelta(datetime.today(), new_value).years > 70:
-            raise ValidationError(self.error_messages['birthday'])
+        if new_value and new_value <= birthday_cutoff_today():
+            raise self.validation_errors['birthday']
         return new_value
 
 
@@ -261,7 +416,7 @@ class GenderField(Field):
         if value in self.empty_values:
             return ''
         if value not in GENDERS:
-            raise ValidationError(self.error_messages['gender'])
+            raise self.validation_errors['gender']
         return value
 
 
@@ -274,7 +429,7 @@ class ArgumentsField(Field):
         if value in self.empty_values:
             return {}
         if not isinstance(value, dict):
-            raise ValidationError(self.error_messages['dict'])
+            raise self.validation_errors['dict']
         return value
 
 
@@ -283,9 +438,9 @@ class ClientsInterestsRequest(Request):
     date = DateField(required=False, nullable=True)
 
     def get_response(self, ctx, store, is_admin=False):
-        response = {}
-        for client in self.client_ids:
-            response[str(client)] = get_interests(store, '')
+        interests = get_interests_many(store, self.client_ids)
+        response = dict(
+            (str(client), interests[client]) for client in self.client_ids)
         ctx['nclients'] = len(self.client_ids)
         return response, OK
 
@@ -298,6 +453,14 @@ class OnlineScoreRequest(Request):
     birthday = BirthDayField(required=False, nullable=True)
     gender = GenderField(required=False, nullable=True)
 
+    @property
+    def score_arguments(self):
+        return {
+            'phone': self.phone, 'email': self.email,
+            'birthday': self.birthday, 'gender': self.gender,
+            'first_name': self.first_name, 'last_name': self.last_name,
+        }
+
     def get_response(self, ctx, store, is_admin=False):
         if is_admin:
             score = 42
@@ -310,22 +473,23 @@ class OnlineScoreRequest(Request):
         ctx['has'] = self.not_empty_fields
         return {'score': score}, OK
 
+    validate_set = (
+            ('phone', 'email'),
+            ('first_name', 'last_name'),
+            ('gender', 'birthday')
+    )
+    invalid_set_error = ValidationError({
+        'pair_not_exist': "Invalid set of fields {}".format(validate_set),
+    })
+
     def clean(self):
-        validate_set = (
-                ('phone', 'email'),
-                ('first_name', 'last_name'),
-                ('gender', 'birthday')
-        )
-        for one_set in validate_set:
+        errors = self.errors
+        for one_set in self.validate_set:
             if all(self.data.get(name) not in EMPTY_VALUES and
-                   name not in self._errors for name in one_set
+                   name not in errors for name in one_set
                    ):
                 return
-
-        error_messages = {
-            'pair_not_exist': "Invalid set of fields {}".format(validate_set),
-        }
-        raise ValidationError(error_messages)
+        raise self.invalid_set_error
 
 
 class MethodRequest(Request):
@@ -340,100 +504,630 @@ class MethodRequest(Request):
         return self.login == ADMIN_LOGIN
 
 
+verified_tokens = LocalCache(AUTH_CACHE_SIZE)
+admin_digest = (0, None)
+
+
+def get_admin_digest():
+    """Return the admin digest, it changes once an hour."""
+    global admin_digest
+    valid_till, digest = admin_digest
+    if time.time() >= valid_till:
+        now = datetime.now()
+        digest = hashlib.sha512(now.strftime("%Y%m%d%H") +
+                                ADMIN_SALT).hexdigest()
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + \
+            timedelta(hours=1)
+        admin_digest = (time.mktime(next_hour.timetuple()), digest)
+    return digest
+
+
+def is_same_token(digest, token):
+    """Compare a digest with a token in constant time."""
+    if isinstance(token, six.text_type):
+        try:
+            token = token.encode('ascii')
+        except UnicodeError:
+            return False
+    if not isinstance(token, str):
+        return False
+    return hmac.compare_digest(digest, token)
+
+
 def check_auth(request):
+    if not isinstance(request.token, six.string_types):
+        return False
     if request.is_admin:
-        digest = hashlib.sha512(datetime.now().strftime(
-            "%Y%m%d%H") + ADMIN_SALT).hexdigest()
-    else:
-        digest = hashlib.sha512(
-            request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
+        return is_same_token(get_admin_digest(), request.token)
+
+    key = (request.account, request.login, request.token)
+    if verified_tokens.get(key):
+        return True
+    digest = hashlib.sha512(
+        request.account + request.login + SALT).hexdigest()
+    if is_same_token(digest, request.token):
+        verified_tokens.set(key, True, float('inf'))
         return True
     return False
 
 
-def method_handler(request, ctx, store):
-    handlers = {
-        'clients_interests': ClientsInterestsRequest,
-        'online_score': OnlineScoreRequest
-    }
+METHODS = {
+    'clients_interests': ClientsInterestsRequest,
+    'online_score': OnlineScoreRequest
+}
 
-    method_request = MethodRequest(request["body"])
+
+def prepare_method(body):
+    """
+    Validate and authenticate a method request. Return the valid request
+    of the method with the method request, or None and an error response.
+    """
+    with STAGE_LATENCY.time(VALIDATION):
+        method_request = MethodRequest(body)
+        valid = method_request.is_valid()
+    if not valid:
+        return None, (method_request.errors, INVALID_REQUEST)
+
+    with STAGE_LATENCY.time(CHECK_AUTH):
+        authorized = check_auth(method_request)
+    if not authorized:
+        return None, (ERRORS[FORBIDDEN], FORBIDDEN)
+
+    if method_request.method in METHODS:
+        with STAGE_LATENCY.time(VALIDATION):
+            handler = METHODS[method_request.method](method_request.arguments)
+            valid = handler.is_valid()
+        if valid:
+            return (handler, method_request), None
+        return None, (handler.errors, INVALID_REQUEST)
+
+    return None, (ERRORS[INVALID_REQUEST], INVALID_REQUEST)
+
+
+def method_handler(request, ctx, store):
+    prepared, error = prepare_method(request["body"])
+    if error is not None:
+        return error
+    handler, method_request = prepared
+    ctx['method'] = method_request.method
+    return handler.get_response(ctx, store, method_request.is_admin)
+
+
+def batch_handler(request, ctx, store):
+    """
+    Run a list of method requests. Scores are read from and written to
+    the cache at once and interests of all clients are read at once.
+    """
+    items = request["body"]
+    if not isinstance(items, list):
+        return ERRORS[INVALID_REQUEST], INVALID_REQUEST
+
+    results = [None] * len(items)
+    scores = []
+    interests = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = ERRORS[INVALID_REQUEST], INVALID_REQUEST
+            continue
+        prepared, error = prepare_method(item)
+        if error is not None:
+            results[index] = error
+            continue
+        handler, method_request = prepared
+        if isinstance(handler, ClientsInterestsRequest):
+            interests.append((index, handler))
+        elif method_request.is_admin:
+            results[index] = {'score': 42}, OK
+        else:
+            scores.append((index, handler))
+
+    if scores:
+        people = [handler.score_arguments for index, handler in scores]
+        for (index, handler), score in zip(scores, get_scores(store, people)):
+            results[index] = {'score': score}, OK
+
+    if interests:
+        client_ids = set()
+        for index, handler in interests:
+            client_ids.update(handler.client_ids)
+        found = get_interests_many(store, list(client_ids))
+        for index, handler in interests:
+            results[index] = dict((str(client), found[client])
+                                  for client in handler.client_ids), OK
+
+    ctx['batch'] = len(items)
+    return [make_result(response, code) for response, code in results], OK
+
+
+def method_precheck(members):
+    """
+    Check a method request before its arguments are read, members are
+    the fields sent before arguments. Return an error response or None.
+    """
+    names = [name for name, field in MethodRequest.base_fields
+             if name != 'arguments']
+    if not all(name in members for name in names):
+        return None
+    method_request = MethodRequest(dict(members, arguments={}))
     if not method_request.is_valid():
         return method_request.errors, INVALID_REQUEST
-
     if not check_auth(method_request):
         return ERRORS[FORBIDDEN], FORBIDDEN
+    return None
+
+
+def make_result(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"),
+            "code": code}
+
 
-    if method_request.method in handlers:
-        handler = handlers[method_request.method](method_request.arguments)
-        if handler.is_valid():
-            return handler.get_response(ctx, store, method_request.is_admin)
-        return handler.errors, INVALID_REQUEST
+def ready_handler(request, ctx, store):
+    if store.is_alive:
+        return {"ready": True}, OK
+    return ERRORS[SERVICE_UNAVAILABLE], SERVICE_UNAVAILABLE
 
-    return ERRORS[INVALID_REQUEST], INVALID_REQUEST
+
+def metrics_handler(request, ctx, store):
+    return metrics.render(), OK
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
+    }
+    get_router = {
+        "ready": ready_handler
+    }
+    # GET routes answering with plain text instead of a JSON envelope
+    text_router = {
+        "metrics": (metrics_handler, "text/plain; version=0.0.4")
+    }
+    # Requests which can be rejected before the given member is read
+    prechecks = {
+        "method": ("arguments", method_precheck)
     }
-    store = Store()
+    max_body_size = 1024 * 1024
+    chunk_size = 64 * 1024
+
+    # Persistent connections of servers which keep them (keepalive),
+    # an idle connection is closed after timeout seconds or after
+    # max_keepalive_requests requests
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+    max_keepalive_requests = 1000
+    # Send a response with one write
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # Share of requests logged with their body
+    log_body_rate = 1.0
+    # Connections are opened on first use
+    store = TarantoolStore()
+    # Seconds which all store calls of a request may take with retries
+    store_deadline = 2
+
+    def setup(self):
+        # The single and prefork engines serve one connection at a time,
+        # so an idle persistent connection would block the others
+        if not getattr(self.server, 'keepalive', False):
+            self.protocol_version = "HTTP/1.0"
+        BaseHTTPRequestHandler.setup(self)
+
+    def handle(self):
+        served = getattr(self.server, 'served', {})
+        self.served_requests = served.get(self.request, 0)
+        self.parked = False
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            # The server watches the idle connection if the next request
+            # is not read yet (there is nothing in the read buffer)
+            if hasattr(self.server, 'park') and not self.rfile._rbuf.tell():
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def get_store(self):
+        """Return the store of the current worker or the shared one."""
+        return getattr(self.server, 'store', None) or self.store
+
+    def log_message(self, format, *args):
+        # Access lines go through the log queue instead of stderr
+        logging.info("%s - " + format, self.client_address[0], *args)
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def read_request(self, path, length):
+        """
+        Read the body by chunks and decode it. Return the request and
+        None, or None and an error response if the request was rejected
+        before the whole body was read.
+        """
+        scanner = None
+        if path in self.prechecks:
+            stop_key, precheck = self.prechecks[path]
+            scanner = ObjectScanner(stop_keys=(stop_key,))
+        chunks = []
+        left = length
+        while left > 0:
+            chunk = self.rfile.read(min(left, self.chunk_size))
+            if not chunk:
+                raise ValueError("Body is shorter than Content-Length")
+            chunks.append(chunk)
+            left -= len(chunk)
+            if scanner is not None:
+                scanner.feed(chunk, complete=not left)
+                if scanner.stopped:
+                    rejected = precheck(scanner.members)
+                    if rejected is not None:
+                        return None, rejected
+                    scanner = None
+        return serialization.loads(''.join(chunks)), None
+
     def do_POST(self):
+        self.started = time.time()
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
+        path = self.path.strip("/")
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
-        except:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = -1
+
+        if length < 0:
             code = BAD_REQUEST
+        elif length > self.max_body_size:
+            code = REQUEST_ENTITY_TOO_LARGE
+        else:
+            try:
+                request, rejected = self.read_request(path, length)
+            except:
+                code = BAD_REQUEST
+            else:
+                if rejected is not None:
+                    response, code = rejected
+                    logging.info("%s: rejected before arguments %s",
+                                 self.path, context["request_id"])
+        if request is None:
+            # The rest of the body is not read
+            self.close_connection = 1
 
         if request:
-            path = self.path.strip("/")
-            logging.info(
-                "%s: %s %s" % (self.path, data_string, context["request_id"]))
+            if random.random() < self.log_body_rate:
+                logging.info("%s: %s %s", self.path, request,
+                             context["request_id"])
             if path in self.router:
                 try:
-                    response, code = self.router[path](
-                        {"body": request, "headers": self.headers}, context,
-                        self.store)
+                    with request_deadline(self.store_deadline):
+                        response, code = self.router[path](
+                            {"body": request, "headers": self.headers},
+                            context, self.get_store())
                 except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
+                    logging.exception("Unexpected error: %s", e)
                     code = INTERNAL_ERROR
             else:
                 code = NOT_FOUND
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+        self.send_result(response, code, context)
+
+    def do_GET(self):
+        self.started = time.time()
+        response, code = {}, OK
+        context = {"request_id": self.get_request_id(self.headers)}
+        path = self.path.strip("/")
+        if path in self.text_router:
+            handler, content_type = self.text_router[path]
+            response, code = handler(
+                {"headers": self.headers}, context, self.get_store())
+            self.send_body(response, code, content_type, context)
+            return
+        if path in self.get_router:
+            response, code = self.get_router[path](
+                {"headers": self.headers}, context, self.get_store())
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"),
-                 "code": code}
+            code = NOT_FOUND
+        self.send_result(response, code, context)
+
+    def send_result(self, response, code, context):
+        r = make_result(response, code)
         context.update(r)
         logging.info(context)
-        self.wfile.write(json.dumps(r))
-        return
+        self.send_body(serialization.dumps(r), code, "application/json",
+                       context)
+
+    def send_body(self, body, code, content_type, context):
+        self.served_requests += 1
+        if self.served_requests >= self.max_keepalive_requests:
+            self.close_connection = 1
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+        self.observe(code, context)
+
+    def observe(self, code, context):
+        path = self.path.strip("/")
+        method = context.get("method")
+        if method is None:
+            known = path in self.router or path in self.get_router or \
+                path in self.text_router
+            method = path if known else "unknown"
+        labels = (method, str(code))
+        REQUESTS.inc(labels)
+        REQUEST_LATENCY.observe(time.time() - self.started, labels)
+
+
+class ReusePortHTTPServer(HTTPServer):
+    """HTTPServer which lets several processes bind the same port."""
+    def server_bind(self):
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTPServer with a fixed pool of worker threads.
+    Worker threads share one store, its connection pool is thread-safe.
+    Idle connections don't occupy workers, one thread watches them and
+    passes a connection to workers when its next request comes or closes
+    it after the handler timeout.
+    """
+    keepalive = True
+
+    def __init__(self, server_address, handler_class, workers=1,
+                 store_class=TarantoolStore):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.store = store_class()
+        self.requests = Queue(workers * 2)
+        # Requests served by a connection which waits in the queue again
+        self.served = {}
+        self.parked = []
+        self.parked_lock = threading.Lock()
+        self.closed = False
+        self.wakeup = os.pipe()
+        watcher = threading.Thread(target=self.watch_idle_connections)
+        watcher.daemon = True
+        watcher.start()
+        self.workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self.process_request_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request_worker(self):
+        while True:
+            request, client_address, served = self.requests.get()
+            if served:
+                self.served[request] = served
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except socket.error:
+                # The client reset the connection, it is closed below
+                pass
+            except Exception:
+                self.handle_error(request, client_address)
+            self.served.pop(request, None)
+            if getattr(handler, 'parked', False):
+                self.park(request, client_address, handler.served_requests)
+            else:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        # A new connection waits for its first request like an idle one
+        self.park(request, client_address, 0)
+
+    def park(self, request, client_address, served):
+        """Watch an idle persistent connection till its next request."""
+        if self.closed:
+            self.shutdown_request(request)
+            return
+        with self.parked_lock:
+            self.parked.append((request, client_address, served))
+        os.write(self.wakeup[1], 'x')
+
+    def watch_idle_connections(self):
+        poller = select.poll()
+        poller.register(self.wakeup[0], select.POLLIN)
+        idle = {}
+        while True:
+            timeout = None
+            if idle:
+                idle_till = min(item[3] for item in idle.values())
+                timeout = max(0, (idle_till - time.time()) * 1000)
+            events = poller.poll(timeout)
+            now = time.time()
+            for fd, event in events:
+                if fd == self.wakeup[0]:
+                    os.read(fd, 4096)
+                    if self.closed:
+                        for item in idle.values():
+                            self.shutdown_request(item[0])
+                        os.close(self.wakeup[0])
+                        return
+                    with self.parked_lock:
+                        parked, self.parked = self.parked, []
+                    for request, client_address, served in parked:
+                        idle[request.fileno()] = (
+                            request, client_address, served,
+                            now + self.RequestHandlerClass.timeout)
+                        poller.register(request, select.POLLIN)
+                    continue
+                # The next request or the client closed the connection
+                request, client_address, served, _ = idle.pop(fd)
+                poller.unregister(fd)
+                self.requests.put((request, client_address, served))
+            for fd, item in list(idle.items()):
+                if item[3] <= now:
+                    del idle[fd]
+                    poller.unregister(fd)
+                    self.shutdown_request(item[0])
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.closed = True
+        os.write(self.wakeup[1], 'x')
+        os.close(self.wakeup[1])
+
+
+def serve(server):
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def serve_prefork(server_address, handler_class, workers,
+                  store_class=TarantoolStore):
+    """
+    Fork workers which accept connections on the same port.
+    The kernel balances connections between them with SO_REUSEPORT.
+    A worker which exits is forked again, SIGTERM or Ctrl-C stops
+    the workers and the parent waits for them.
+    """
+    def fork_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            server = ReusePortHTTPServer(server_address, handler_class)
+            server.store = store_class()
+            serve(server)
+            # Write the queued log records, exit handlers are not run
+            logging.shutdown()
+            os._exit(0)
+        children[pid] = time.time()
+
+    def stop(signum=None, frame=None):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    children = {}
+    stopping = []
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(workers):
+        fork_worker()
+
+    while children:
+        try:
+            pid, status = os.waitpid(-1, 0)
+            started = children.pop(pid, None)
+            if started is None or stopping:
+                continue
+            logging.error("Worker %s exited with status %s, forking a new "
+                          "one", pid, status)
+            # A worker which fails at start is not forked again at once
+            if time.time() - started < 1:
+                time.sleep(1)
+            if not stopping:
+                fork_worker()
+        except KeyboardInterrupt:
+            stop()
+        except OSError as e:
+            # waitpid is interrupted by SIGTERM
+            if e.errno == errno.ECHILD:
+                break
+            if e.errno != errno.EINTR:
+                raise
+
+
+ENGINES = ('single', 'thread', 'prefork')
+
+
+def parse_address(value):
+    """Parse host:port of a store replica."""
+    host, _, port = value.rpartition(":")
+    return host, int(port)
+
+
+def add_store_options(op):
+    op.add_option("-s", "--store", action="store", type="choice",
+                  choices=sorted(BACKENDS), default="tarantool")
+    op.add_option("--store-path", action="store",
+                  default=os.path.join(tempfile.gettempdir(), "scoring.store"),
+                  help="file of the shared store")
+    op.add_option("--store-host", action="store", default="tarantool")
+    op.add_option("--store-port", action="store", type=int, default=3301)
+    op.add_option("--store-pool", action="store", type=int, default=None,
+                  help="connections in the pool, 4 or --workers of the "
+                       "thread engine by default")
+    op.add_option("--store-replica", action="append", default=[],
+                  help="host:port of a store replica, can be repeated")
+    op.add_option("--local-cache", action="store", type=int, default=0,
+                  help="entries in the in-process score cache, 0 is off")
+
+
+def store_factory(opts):
+    """Return a function which creates the store chosen by options."""
+    if opts.store == 'memory':
+        return BACKENDS['memory']
+    if opts.store == 'shared':
+        return functools.partial(BACKENDS['shared'], opts.store_path)
+    return functools.partial(
+        BACKENDS['tarantool'], host=opts.store_host, port=opts.store_port,
+        pool_size=opts.store_pool or 4,
+        replicas=[parse_address(r) for r in opts.store_replica],
+        local_cache_size=opts.local_cache)
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-e", "--engine", action="store", type="choice",
+                  choices=ENGINES, default="single")
+    op.add_option("-w", "--workers", action="store", type=int,
+                  default=multiprocessing.cpu_count())
+    op.add_option("-m", "--max-body", action="store", type=int,
+                  default=MainHTTPHandler.max_body_size,
+                  help="maximum size of a request body in bytes")
+    op.add_option("--keepalive-timeout", action="store", type=float,
+                  default=MainHTTPHandler.timeout,
+                  help="seconds to keep an idle connection open")
+    op.add_option("--keepalive-requests", action="store", type=int,
+                  default=MainHTTPHandler.max_keepalive_requests,
+                  help="requests served by one connection")
+    op.add_option("--log-json", action="store_true", default=False,
+                  help="write log records as JSON lines")
+    op.add_option("--log-body-rate", action="store", type=float,
+                  default=MainHTTPHandler.log_body_rate,
+                  help="share of requests logged with their body, 0..1")
+    add_store_options(op)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s',
-                        datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    setup_logging(opts.log, opts.log_json)
+    MainHTTPHandler.log_body_rate = opts.log_body_rate
+    MainHTTPHandler.max_body_size = opts.max_body
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    MainHTTPHandler.max_keepalive_requests = opts.keepalive_requests
+    address = ("localhost", opts.port)
+    if opts.engine == 'thread' and opts.store_pool is None:
+        # Workers share one store, a connection for every worker
+        opts.store_pool = opts.workers
+    store_class = store_factory(opts)
+    logging.info("Starting %s server at %s", opts.engine, opts.port)
+    if opts.engine == 'prefork':
+        serve_prefork(address, MainHTTPHandler, opts.workers, store_class)
+    elif opts.engine == 'thread':
+        serve(PooledHTTPServer(
+            address, MainHTTPHandler, opts.workers, store_class))
+    else:
+        server = HTTPServer(address, MainHTTPHandler)
+        server.store = store_class()
+        serve(server)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Logging which doesn't block request threads. Records are put into
+a bounded queue and formatted and written by a background thread.
+"""
+
+import logging
+import os
+import threading
+import time
+from Queue import Queue, Full
+
+import serialization
+from metrics import Counter
+
+DROPPED = Counter('log_records_dropped_total',
+                  'Log records dropped because the log queue was full.')
+
+STOP = object()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as a JSON line. A dict message is merged into
+    the line, any other message goes to "message".
+    """
+    def format(self, record):
+        line = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+        }
+        if isinstance(record.msg, dict) and not record.args:
+            line.update(record.msg)
+        else:
+            line["message"] = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line["exception"] = record.exc_text
+        try:
+            return serialization.dumps(line)
+        except (TypeError, ValueError, OverflowError):
+            return serialization.dumps(dict(
+                (key, repr(value)) for key, value in line.items()))
+
+
+class QueueHandler(logging.Handler):
+    """
+    Pass records to the target handler through a queue of queue_size
+    records. Records are dropped when the queue is full, so a slow disk
+    doesn't slow down requests. After fork the child process starts its
+    own writer thread with new locks.
+    """
+    def __init__(self, target, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue_size = queue_size
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.queue = Queue(self.queue_size)
+        self.writer = None
+        self.start_lock = threading.Lock()
+
+    def handle(self, record):
+        if self.pid != os.getpid():
+            # A thread of the parent may have held the locks at fork,
+            # it doesn't exist in the child to release them
+            self.createLock()
+            self.target.createLock()
+            self.reset()
+        return logging.Handler.handle(self, record)
+
+    def start_writer(self):
+        with self.start_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_forever)
+                self.writer.daemon = True
+                self.writer.start()
+
+    def write_forever(self):
+        while True:
+            record = self.queue.get()
+            if record is STOP:
+                return
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+    def emit(self, record):
+        if self.writer is None:
+            self.start_writer()
+        if record.exc_info:
+            # A traceback refers to frames of the request thread
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            DROPPED.inc()
+
+    def close(self, timeout=5):
+        """Write the queued records and stop the writer."""
+        if self.writer is not None and self.pid == os.getpid():
+            deadline = time.time() + timeout
+            try:
+                self.queue.put(STOP, timeout=timeout)
+            except Full:
+                pass
+            self.writer.join(max(0, deadline - time.time()))
+            self.writer = None
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def setup_logging(path=None, json_lines=False, level=logging.INFO):
+    """Log to the file or stderr through a QueueHandler."""
+    if path:
+        target = logging.FileHandler(path)
+    else:
+        target = logging.StreamHandler()
+    datefmt = '%Y.%m.%d %H:%M:%S'
+    if json_lines:
+        target.setFormatter(JsonFormatter(datefmt=datefmt))
+    else:
+        target.setFormatter(logging.Formatter(
+            '[%(asctime)s] %(levelname).1s %(message)s', datefmt=datefmt))
+    handler = QueueHandler(target)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
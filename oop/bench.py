@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import httplib
+import json
+import platform
+import threading
+import time
+import timeit
+from datetime import datetime
+from optparse import OptionParser
+
+import api
+from store import MemoryStore
+
+
+ACCOUNT = "horns&hoofs"
+LOGIN = "h&f"
+TOKEN = hashlib.sha512(ACCOUNT + LOGIN + api.SALT).hexdigest()
+
+SCORE_ARGUMENTS = {
+    "phone": "79175002040", "email": "ivan@com.com",
+    "first_name": "Ivan", "last_name": "Ivanov",
+    "birthday": "01.01.1990", "gender": 1,
+}
+INTERESTS_ARGUMENTS = {"client_ids": [1, 2, 3, 4], "date": "20.07.2017"}
+
+
+def method_body(method, arguments):
+    return {
+        "account": ACCOUNT, "login": LOGIN, "token": TOKEN,
+        "method": method, "arguments": arguments,
+    }
+
+
+class QuietHTTPHandler(api.MainHTTPHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def measure(func, number):
+    """Return the best time of one call in microseconds."""
+    timer = timeit.Timer(func)
+    best = min(timer.repeat(repeat=3, number=number))
+    return {"usec": best / number * 1e6, "number": number}
+
+
+def micro_benchmarks(number):
+    fields = [
+        ("CharField", api.CharField(), "Ivan"),
+        ("DateField", api.DateField(), "20.07.2017"),
+        ("ClientIDsField", api.ClientIDsField(), [1, 2, 3, 4]),
+        ("PhoneField", api.PhoneField(), "79175002040"),
+        ("EmailField", api.EmailField(), "ivan@com.com"),
+        ("BirthDayField", api.BirthDayField(), "01.01.1990"),
+        ("GenderField", api.GenderField(), 1),
+        ("ArgumentsField", api.ArgumentsField(), {"a": 1}),
+    ]
+    results = {}
+    for name, field, value in fields:
+        results["clean." + name] = measure(
+            lambda: field.clean(value), number)
+
+    body = method_body("online_score", SCORE_ARGUMENTS)
+    method_request = api.MethodRequest(body)
+    store = MemoryStore()
+    results["validate.MethodRequest"] = measure(
+        lambda: api.MethodRequest(body).is_valid(), number)
+    results["validate.OnlineScoreRequest"] = measure(
+        lambda: api.OnlineScoreRequest(SCORE_ARGUMENTS).is_valid(), number)
+    results["validate.ClientsInterestsRequest"] = measure(
+        lambda: api.ClientsInterestsRequest(INTERESTS_ARGUMENTS).is_valid(),
+        number)
+    results["check_auth"] = measure(
+        lambda: api.check_auth(method_request), number)
+    results["get_score"] = measure(
+        lambda: api.get_score(store, **SCORE_ARGUMENTS), number)
+    return results
+
+
+def handler_benchmarks(number):
+    store = MemoryStore()
+    results = {}
+    for method, arguments in (("online_score", SCORE_ARGUMENTS),
+                              ("clients_interests", INTERESTS_ARGUMENTS)):
+        request = {"body": method_body(method, arguments), "headers": {}}
+        results["method_handler." + method] = measure(
+            lambda: api.method_handler(request, {}, store), number)
+    return results
+
+
+def percentile(values, percent):
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def load_benchmark(rate, duration, clients, workers):
+    """
+    Drive MainHTTPHandler at the target rate of requests per second
+    and return latency percentiles in milliseconds.
+    """
+    server = api.PooledHTTPServer(
+        ("localhost", 0), QuietHTTPHandler, workers=workers,
+        store_class=MemoryStore)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    body = json.dumps(method_body("online_score", SCORE_ARGUMENTS))
+    total = int(rate * duration)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = time.time() + 0.1
+
+    def client(offset):
+        # Every client sends every n-th request of the schedule
+        for i in range(offset, total, clients):
+            delay = start + float(i) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sent = time.time()
+            try:
+                connection = httplib.HTTPConnection(
+                    "localhost", server.server_port)
+                connection.request("POST", "/method/", body)
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+                ok = response.status == api.OK
+            except Exception:
+                ok = False
+            with lock:
+                latencies.append(time.time() - sent)
+                if not ok:
+                    errors.append(i)
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    server.shutdown()
+    server.server_close()
+
+    latencies.sort()
+    return {"load.online_score": {
+        "target_rate": rate,
+        "rate": len(latencies) / elapsed,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }}
+
+
+def compare(results, baseline):
+    """Print the relative change of every result against the baseline."""
+    for name, result in sorted(results.items()):
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        for metric in ("usec", "p50_ms", "p99_ms"):
+            if metric in result and old.get(metric):
+                change = (result[metric] - old[metric]) / old[metric] * 100
+                print("%-40s %-7s %10.2f -> %10.2f %+7.1f%%" % (
+                    name, metric, old[metric], result[metric], change))
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=10000,
+                  help="calls for every micro and handler benchmark")
+    op.add_option("-r", "--rate", action="store", type=int, default=200,
+                  help="target requests per second of the load test")
+    op.add_option("-d", "--duration", action="store", type=float,
+                  default=5, help="duration of the load test in seconds")
+    op.add_option("-c", "--clients", action="store", type=int, default=8)
+    op.add_option("-w", "--workers", action="store", type=int, default=8)
+    op.add_option("-o", "--output", action="store", default=None,
+                  help="file to save results as JSON")
+    op.add_option("--compare", action="store", default=None,
+                  help="JSON results of a previous run")
+    op.add_option("--skip-load", action="store_true", default=False)
+    (opts, args) = op.parse_args()
+
+    results = {}
+    results.update(micro_benchmarks(opts.number))
+    results.update(handler_benchmarks(opts.number))
+    if not opts.skip_load:
+        results.update(load_benchmark(
+            opts.rate, opts.duration, opts.clients, opts.workers))
+
+    report = {
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(results, json.load(f))
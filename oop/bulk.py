@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Score a file of OnlineScoreRequest records outside of the HTTP server.
+Records are read as JSON lines or CSV, validated by the same fields as
+online requests and scored by batches in a pool of processes.
+Every output line is JSON with the record id (its "id" or line number)
+and either the score or the errors.
+"""
+
+import csv
+import logging
+import multiprocessing
+import sys
+import time
+from collections import deque
+from itertools import islice
+from optparse import OptionParser
+
+import serialization
+from api import (BAD_REQUEST, INVALID_REQUEST, OK, OnlineScoreRequest,
+                 add_store_options, store_factory)
+from scoring import get_scores
+
+store = None
+
+
+def init_worker(store_class):
+    global store
+    store = store_class()
+
+
+class Malformed(object):
+    """A line which is not JSON, it gets a bad request result."""
+    def __init__(self, error):
+        self.error = error
+
+
+def read_json_lines(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                yield serialization.loads(line)
+            except ValueError as e:
+                yield Malformed(str(e))
+
+
+def read_csv(f):
+    for record in csv.DictReader(f):
+        # CSV has only strings, gender is a number in requests
+        if record.get('gender', '').isdigit():
+            record['gender'] = int(record['gender'])
+        yield record
+
+
+READERS = {
+    'json': read_json_lines,
+    'csv': read_csv,
+}
+
+
+def read_batches(records, size):
+    records = iter(records)
+    number = 0
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield [(number + i + 1, record) for i, record in enumerate(batch)]
+        number += len(batch)
+
+
+def score_batch(batch):
+    """Score a batch of (line number, record) with one cache read/write."""
+    results = []
+    valid = []
+    for number, record in batch:
+        if isinstance(record, Malformed):
+            results.append({"id": number, "code": BAD_REQUEST,
+                            "error": record.error})
+            continue
+        if not isinstance(record, dict):
+            results.append({"id": number, "code": INVALID_REQUEST,
+                            "error": "Record must be an object"})
+            continue
+        result = {"id": record.get('id', number), "code": OK}
+        request = OnlineScoreRequest(record)
+        if request.is_valid():
+            valid.append((result, request.score_arguments))
+        else:
+            result.update(code=INVALID_REQUEST, error=request.errors)
+        results.append(result)
+
+    if valid:
+        scores = get_scores(store, [arguments for _, arguments in valid])
+        for (result, _), score in zip(valid, scores):
+            result["score"] = score
+    return results
+
+
+def score_file(records, output, workers, batch_size, store_class):
+    """
+    Score records in a pool of processes and write results in order.
+    Only a few batches per worker are in flight, so memory is bounded
+    whatever the size of the input is.
+    """
+    pool = multiprocessing.Pool(workers, init_worker, (store_class,))
+    pending = deque()
+    total = 0
+    try:
+        for batch in read_batches(records, batch_size):
+            pending.append(pool.apply_async(score_batch, (batch,)))
+            if len(pending) >= workers * 2:
+                total += write_results(pending.popleft().get(), output)
+        while pending:
+            total += write_results(pending.popleft().get(), output)
+    finally:
+        pool.terminate()
+    return total
+
+
+def write_results(results, output):
+    output.writelines(serialization.dumps(result) + "\n"
+                      for result in results)
+    return len(results)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [input]")
+    op.add_option("-o", "--output", action="store", default=None,
+                  help="file to write scores, stdout by default")
+    op.add_option("-f", "--format", action="store", type="choice",
+                  choices=sorted(READERS), default=None,
+                  help="input format, by default from the file extension")
+    op.add_option("-w", "--workers", action="store", type=int,
+                  default=multiprocessing.cpu_count())
+    op.add_option("-b", "--batch", action="store", type=int, default=1000,
+                  help="records scored with one cache read and write")
+    add_store_options(op)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+
+    path = args[0] if args else None
+    file_format = opts.format or (
+        'csv' if path and path.endswith('.csv') else 'json')
+    source = open(path) if path else sys.stdin
+    output = open(opts.output, 'w') if opts.output else sys.stdout
+
+    started = time.time()
+    total = score_file(READERS[file_format](source), output, opts.workers,
+                       opts.batch, store_factory(opts))
+    output.flush()
+    elapsed = time.time() - started
+    logging.info("Scored %s records in %.1f s (%.0f records/s)" % (
+        total, elapsed, total / elapsed if elapsed else 0))
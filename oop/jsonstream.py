@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+from json.decoder import scanstring
+
+WHITESPACE = ' \t\n\r'
+
+START, KEY, COLON, VALUE, COMMA, DONE, STOPPED = range(7)
+
+
+class ObjectScanner(object):
+    """
+    Incremental scanner of the top-level members of a JSON object.
+    Members are decoded as soon as they are complete. Scanning stops
+    at a member from stop_keys, its value is not buffered by the scanner.
+    Raise ValueError as soon as the data can't be a JSON object.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, stop_keys=()):
+        self.stop_keys = stop_keys
+        self.members = {}
+        self.buffer = ''
+        self.pos = 0
+        self.state = START
+        self.key = None
+        self.first = True
+
+    @property
+    def stopped(self):
+        return self.state == STOPPED
+
+    def feed(self, data, complete=False):
+        if self.state in (DONE, STOPPED):
+            return
+        self.buffer += data
+        self.scan(complete)
+
+    def skip_whitespace(self, pos):
+        while pos < len(self.buffer) and self.buffer[pos] in WHITESPACE:
+            pos += 1
+        return pos
+
+    def scan(self, complete):
+        buf = self.buffer
+        while self.state not in (DONE, STOPPED):
+            pos = self.skip_whitespace(self.pos)
+            if pos >= len(buf):
+                if complete:
+                    raise ValueError("Unexpected end of data")
+                return
+            char = buf[pos]
+            if self.state == START:
+                if char != '{':
+                    raise ValueError("Expecting object")
+                self.state, self.pos = KEY, pos + 1
+            elif self.state == KEY:
+                if char == '}' and self.first:
+                    self.state = DONE
+                    return
+                if char != '"':
+                    raise ValueError("Expecting property name")
+                try:
+                    self.key, self.pos = scanstring(buf, pos + 1)
+                except ValueError:
+                    if complete:
+                        raise
+                    return
+                self.state = COLON
+            elif self.state == COLON:
+                if char != ':':
+                    raise ValueError("Expecting ':' delimiter")
+                self.state, self.pos = VALUE, pos + 1
+            elif self.state == VALUE:
+                if self.key in self.stop_keys:
+                    self.state = STOPPED
+                    return
+                try:
+                    value, end = self.decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if complete:
+                        raise
+                    return
+                # A number at the end of data may be not complete yet
+                if end == len(buf) and not complete:
+                    return
+                self.members[self.key] = value
+                self.state, self.pos = COMMA, end
+            elif self.state == COMMA:
+                if char == ',':
+                    self.state, self.first = KEY, False
+                elif char == '}':
+                    self.state = DONE
+                else:
+                    raise ValueError("Expecting ',' delimiter")
+                self.pos = pos + 1
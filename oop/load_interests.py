@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load interests of clients into the store from a file.
+Records are JSON lines like {"cid": 1, "interests": ["auto", "books"]}
+or CSV with "cid" and "interests" columns, interests are separated by
+";". Records are saved by batches with one store call each, several
+batches are saved at once.
+"""
+
+import csv
+import logging
+import sys
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+import serialization
+from api import add_store_options, store_factory
+
+
+def skip(number, error):
+    logging.warning("Skipped record %s: %s", number, error)
+
+
+def read_json_lines(f):
+    """Yield (key, interests), lines which are not valid are skipped."""
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = serialization.loads(line)
+            cid, interests = record['cid'], record['interests']
+        except ValueError as e:
+            skip(number, e)
+            continue
+        except (KeyError, TypeError):
+            skip(number, "no cid or interests")
+            continue
+        if not isinstance(interests, list):
+            skip(number, "interests must be a list")
+            continue
+        yield "i:%s" % cid, interests
+
+
+def read_csv(f):
+    for number, record in enumerate(csv.DictReader(f), 1):
+        if not record.get('cid'):
+            skip(number, "no cid")
+            continue
+        interests = record.get('interests')
+        yield "i:%s" % record['cid'], interests.split(';') if interests \
+            else []
+
+
+READERS = {
+    'json': read_json_lines,
+    'csv': read_csv,
+}
+
+
+def read_batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Progress(object):
+    """Log loaded records and the rate every `every` records."""
+    def __init__(self, every):
+        self.every = every
+        self.started = time.time()
+        self.total = 0
+        self.reported = 0
+        self.skipped = 0
+        self.skipped_batches = 0
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.total / elapsed if elapsed else 0
+
+    def add(self, count):
+        self.total += count
+        if self.every and self.total - self.reported >= self.every:
+            self.reported = self.total
+            logging.info("Loaded %s records (%.0f records/s)",
+                         self.total, self.rate)
+
+    def skip(self, count, error):
+        self.skipped += count
+        self.skipped_batches += 1
+        logging.error("Skipped a batch of %s records: %s", count, error)
+
+
+def wait_batch(pending, progress):
+    count, result = pending.popleft()
+    try:
+        result.get()
+    except Exception as e:
+        # The batch may be saved partly, the other batches are loaded
+        progress.skip(count, e)
+    else:
+        progress.add(count)
+
+
+def load(store, records, batch_size=1000, workers=4, progress=None):
+    """
+    Save records with store.set_many by batches, up to workers batches
+    at once. A batch which fails is logged and counted in progress.
+    Return the number of saved records.
+    """
+    progress = progress or Progress(0)
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for batch in read_batches(records, batch_size):
+            pending.append((len(batch),
+                            pool.apply_async(store.set_many, (batch,))))
+            if len(pending) >= workers * 2:
+                wait_batch(pending, progress)
+        while pending:
+            wait_batch(pending, progress)
+    finally:
+        pool.terminate()
+    return progress.total
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [input]")
+    op.add_option("-f", "--format", action="store", type="choice",
+                  choices=sorted(READERS), default=None,
+                  help="input format, by default from the file extension")
+    op.add_option("-b", "--batch", action="store", type=int, default=1000,
+                  help="records saved with one store call")
+    op.add_option("-w", "--workers", action="store", type=int, default=4,
+                  help="batches saved at once")
+    op.add_option("--truncate", action="store_true", default=False,
+                  help="remove all interests before loading")
+    op.add_option("--progress", action="store", type=int, default=100000,
+                  help="log progress every N records, 0 is off")
+    add_store_options(op)
+    (opts, args) = op.parse_args()
+    if opts.store not in ('tarantool', 'shared'):
+        # The memory store would be gone with the loader process
+        op.error("interests can be loaded into the tarantool or shared "
+                 "store only")
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+
+    path = args[0] if args else None
+    file_format = opts.format or (
+        'csv' if path and path.endswith('.csv') else 'json')
+    source = open(path) if path else sys.stdin
+    if opts.store == 'tarantool':
+        opts.store_pool = max(opts.store_pool or 0, opts.workers)
+    store = store_factory(opts)()
+
+    if opts.truncate:
+        started = time.time()
+        store.truncate('interests')
+        logging.info("Truncated interests in %.1f s", time.time() - started)
+    progress = Progress(opts.progress)
+    total = load(store, READERS[file_format](source), opts.batch,
+                 opts.workers, progress)
+    elapsed = time.time() - progress.started
+    logging.info("Loaded %s records in %.1f s (%.0f records/s)",
+                 total, elapsed, progress.rate)
+    if progress.skipped_batches:
+        logging.error("Skipped %s batches of %s records",
+                      progress.skipped_batches, progress.skipped)
+        sys.exit(1)
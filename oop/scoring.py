@@ -2,22 +2,78 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
-import json
+import threading
 
+from metrics import Counter
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
-              last_name=None):
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SCORE_CACHE = Counter(
+    'score_cache_requests_total', 'Reads of scores from the cache.',
+    ('result',))
+HIT = ('hit',)
+MISS = ('miss',)
+COALESCED = ('coalesced',)
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Run one call per key at a time. Callers which come with the same key
+    while the call runs wait for it and get its result or its error.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            SCORE_CACHE.inc(COALESCED)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func(*args)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+score_flights = SingleFlight()
+
+
+def score_key(first_name=None, last_name=None, birthday=None):
     key_parts = [
         first_name or "",
         last_name or "",
         birthday if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+
+
+def calculate_score(phone, email, birthday=None, gender=None,
+                    first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -26,14 +82,136 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
+    return score
+
+
+def score_keys(first_names, last_names, birthdays):
+    """Return uid keys of columns of names and birthdays."""
+    md5 = hashlib.md5
+    return ["uid:" + md5((first_name or "") + (last_name or "") + (
+        birthday if birthday is not None else "")).hexdigest()
+        for first_name, last_name, birthday
+        in zip(first_names, last_names, birthdays)]
+
+
+def calculate_scores(has_phone, has_email, has_birthday, has_gender,
+                     has_first_name, has_last_name):
+    """
+    Columnar calculate_score, every argument is a column of flags
+    whether the field is filled. Terms are summed in the same order,
+    so the scores are exactly the same as of calculate_score.
+    """
+    if numpy is not None:
+        columns = [numpy.asarray(column, dtype=bool) for column in (
+            has_phone, has_email, has_birthday, has_gender,
+            has_first_name, has_last_name)]
+        phone, email, birthday, gender, first_name, last_name = columns
+        scores = numpy.zeros(len(phone))
+        scores += phone * 1.5
+        scores += email * 1.5
+        scores += (birthday & gender) * 1.5
+        scores += (first_name & last_name) * 0.5
+        return scores.tolist()
+
+    scores = []
+    for phone, email, birthday, gender, first_name, last_name in zip(
+            has_phone, has_email, has_birthday, has_gender,
+            has_first_name, has_last_name):
+        score = 0
+        if phone:
+            score += 1.5
+        if email:
+            score += 1.5
+        if birthday and gender:
+            score += 1.5
+        if first_name and last_name:
+            score += 0.5
+        scores.append(score)
+    return scores
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
+              last_name=None):
+    """
+    store is any of store.BaseStore implementations. Concurrent calls
+    for the same person read the cache and score once.
+    """
+    key = score_key(first_name, last_name, birthday)
+    # Calls with different stores don't share the score
+    return score_flights.do((id(store), key), cached_score, store, key,
+                            phone, email, birthday, gender, first_name,
+                            last_name)
+
+
+def cached_score(store, key, phone, email, birthday, gender, first_name,
+                 last_name):
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    score = store.cache_get(key) or 0
+    if score:
+        SCORE_CACHE.inc(HIT)
+        return score
+    SCORE_CACHE.inc(MISS)
+    score = calculate_score(phone, email, birthday, gender, first_name,
+                            last_name)
     # cache for 60 minutes
     store.cache_set(key, score,  60*60)
     return score
 
 
+def get_scores(store, people):
+    """
+    Score people given as dicts of get_score arguments with one cache
+    read and one cache write. The result is the same as of get_score
+    called for every person in turn.
+    """
+    keys = score_keys([person.get('first_name') for person in people],
+                      [person.get('last_name') for person in people],
+                      [person.get('birthday') for person in people])
+    cached = store.cache_get_many(list(set(keys))) or {}
+
+    # The first person with a key missing in the cache is scored,
+    # the next ones with the same key get the score from the cache
+    missing = {}
+    for key, person in zip(keys, people):
+        if not cached.get(key) and key not in missing:
+            missing[key] = person
+    hits = sum(1 for key in keys if cached.get(key))
+    SCORE_CACHE.inc(HIT, hits)
+    SCORE_CACHE.inc(MISS, len(keys) - hits)
+    calculated = {}
+    if missing:
+        missing_keys = list(missing)
+        columns = [[bool(missing[key].get(name)) for key in missing_keys]
+                   for name in ('phone', 'email', 'birthday', 'gender',
+                                'first_name', 'last_name')]
+        calculated = dict(zip(missing_keys, calculate_scores(*columns)))
+
+    scores = []
+    for key, person in zip(keys, people):
+        score = cached.get(key) or calculated.get(key)
+        if not score:
+            # Zero scores are not taken from the cache,
+            # so they are calculated for every person as get_score does
+            score = calculated[key] = calculate_score(**person)
+        scores.append(score)
+    if calculated:
+        store.cache_set_many(calculated, 60*60)
+    return scores
+
+
 def get_interests(store, cid):
     try:
         r = store.get("i:%s" % cid)
-        return json.loads(r) if r else []
+        return r or []
+    except:
+        raise Exception("Store doesn\'t work")
+
+
+def get_interests_many(store, cids):
+    keys = ["i:%s" % cid for cid in cids]
+    try:
+        records = store.get_many(keys)
     except:
         raise Exception("Store doesn\'t work")
+    return dict((cid, records.get(key, [])) for cid, key in zip(cids, keys))
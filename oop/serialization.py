@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+JSON encoding and decoding of request and response bodies.
+ujson is used when it is installed, stdlib json otherwise.
+"""
+
+try:
+    import ujson as json
+    ENGINE = 'ujson'
+except ImportError:
+    import json
+    ENGINE = 'json'
+
+loads = json.loads
+dumps = json.dumps
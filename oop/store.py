@@ -1,128 +1,762 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import fcntl
+import functools
+import hashlib
+import mmap
+import os
+import random
+import socket
+import struct
 import tarantool
+import threading
 import time
-import json
+import zlib
 
+import serialization
+from metrics import Counter, Histogram
+from collections import OrderedDict
+from contextlib import contextmanager
+from Queue import LifoQueue, Empty
 
-def with_reconnect(func):
-    attempts = 3
-    delay = 1
 
-    def wrapper(*args, **kwargs):
-        for attempt in range(attempts):
-            try:
-                return func(*args, **kwargs)
-            except Exception:
-                time.sleep(delay * attempt)
-                continue
+class StoreError(Exception):
+    """The store is unavailable."""
+
+
+class PoolError(Exception):
+    """There is no free connection in the pool."""
+
+
+class TableFullError(StoreError):
+    """There is no free slot for a key in the shared store."""
+
+
+STORE_LATENCY = Histogram(
+    'store_call_duration_seconds',
+    'Time of store calls with all their retries.', ('operation',))
+STORE_RETRIES = Counter(
+    'store_retries_total', 'Retried store calls.', ('operation',))
+STORE_ERRORS = Counter(
+    'store_errors_total', 'Store calls failed after all retries.',
+    ('operation',))
+
+
+# Deadlines of the current request and of the current store call
+deadlines = threading.local()
+
+
+@contextmanager
+def request_deadline(seconds):
+    """Fit all store calls made in the block into seconds."""
+    previous = getattr(deadlines, 'request', None)
+    deadlines.request = time.time() + seconds
+    try:
+        yield
+    finally:
+        deadlines.request = previous
+
+
+def time_left(timeout):
+    """Return timeout cut down to the time left of the current store call."""
+    deadline = getattr(deadlines, 'call', None)
+    if deadline is None:
+        return timeout
+    # A zero timeout would make a socket non-blocking
+    return max(0.001, min(timeout, deadline - time.time()))
+
+
+def operation_labels(func):
+    """Labels of store metrics, a private method counts as the public one."""
+    return (func.__name__.lstrip('_'),)
+
+
+class RetryPolicy(object):
+    """
+    Retry transport errors with capped exponential backoff and jitter.
+    All attempts of a call fit into the deadline, which is cut down to the
+    deadline of the request if there is one. After failure_threshold
+    failed calls in a row the circuit opens and calls fail at once until
+    reset_timeout passes.
+    """
+    retry_errors = (tarantool.error.NetworkError, socket.error, PoolError)
+
+    def __init__(self, attempts=3, delay=0.05, max_delay=1, deadline=2,
+                 failure_threshold=5, reset_timeout=10):
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        if self.opened_at is None:
+            return False
+        return time.time() - self.opened_at < self.reset_timeout
+
+    def backoff(self, attempt):
+        return random.uniform(
+            0, min(self.max_delay, self.delay * 2 ** attempt))
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        if self.is_open:
+            STORE_ERRORS.inc(operation_labels(func))
+            raise StoreError("Circuit is open")
+        deadline = time.time() + self.deadline
+        request = getattr(deadlines, 'request', None)
+        if request is not None and request < deadline:
+            deadline = request
+            if time.time() >= deadline:
+                STORE_ERRORS.inc(operation_labels(func))
+                raise StoreError("Deadline of the request exceeded")
+        previous = getattr(deadlines, 'call', None)
+        deadlines.call = deadline
+        try:
+            for attempt in range(self.attempts):
+                try:
+                    result = func(*args, **kwargs)
+                except self.retry_errors as e:
+                    error = e
+                    pause = self.backoff(attempt)
+                    if attempt + 1 == self.attempts or \
+                            time.time() + pause >= deadline:
+                        break
+                    STORE_RETRIES.inc(operation_labels(func))
+                    time.sleep(pause)
+                else:
+                    self.success()
+                    return result
+        finally:
+            deadlines.call = previous
+        self.failure()
+        STORE_ERRORS.inc(operation_labels(func))
+        raise StoreError(error)
+
+
+def with_retry(func):
+    """Retry a store method, raise StoreError if the store is unavailable."""
+    labels = operation_labels(func)
+
+    @functools.wraps(func)
+    def wrapper(store, *args, **kwargs):
+        with STORE_LATENCY.time(labels):
+            return store.retry_policy.call(func, store, *args, **kwargs)
     return wrapper
 
 
-def try_reconnect(func):
-    attempts = 3
-    delay = 1
+def with_silent_retry(func):
+    """Retry a store method, return None if the store is unavailable."""
+    labels = operation_labels(func)
 
-    def wrapper(*args, **kwargs):
-        for attempt in range(attempts):
+    @functools.wraps(func)
+    def wrapper(store, *args, **kwargs):
+        try:
+            with STORE_LATENCY.time(labels):
+                return store.retry_policy.call(func, store, *args, **kwargs)
+        except StoreError:
+            return None
+    return wrapper
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of connections to one or several Tarantool replicas.
+    It is safe to share between threads, after fork the child process
+    drops inherited connections and opens its own ones.
+    """
+    def __init__(self, addresses, size=4, timeout=1, ping_interval=5):
+        self.addresses = list(addresses)
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        # None means the replica was not checked yet
+        self.alive = dict((address, None) for address in self.addresses)
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.slots = LifoQueue(self.size)
+        for _ in range(self.size):
+            self.slots.put(None)
+        self.pinger = None
+
+    @property
+    def is_alive(self):
+        if None in self.alive.values():
+            self.ping()
+        return any(self.alive.values())
+
+    def open(self, address):
+        """
+        Connect to the replica, the socket connects and reads the greeting
+        within the time left, not only the later requests.
+        """
+        connection = tarantool.Connection(
+            address[0], address[1], socket_timeout=self.timeout,
+            reconnect_max_attempts=0, reconnect_delay=0, connect_now=False)
+        connection.address = address
+        try:
+            connection._socket = socket.create_connection(
+                address, time_left(self.timeout))
+            connection._socket.setsockopt(
+                socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            connection.connected = True
+            connection.handshake()
+            connection.load_schema()
+        except Exception as e:
+            if connection._socket is not None:
+                connection._socket.close()
+            if isinstance(e, socket.error):
+                raise tarantool.error.NetworkError(e)
+            raise
+        return connection
+
+    def connect(self):
+        """Open a connection to the first replica which is alive."""
+        error = None
+        for address in sorted(self.addresses, key=lambda a: not self.alive[a]):
             try:
-                return func(*args, **kwargs)
-            except Exception:
-                time.sleep(delay * attempt)
-                args[0].connect()
+                connection = self.open(address)
+            except tarantool.error.NetworkError as e:
+                self.alive[address] = False
+                error = e
                 continue
-    return wrapper
+            self.alive[address] = True
+            return connection
+        raise error
 
+    def close(self, connection):
+        self.alive[connection.address] = False
+        try:
+            connection.close()
+        except Exception:
+            pass
 
-def try_reconnect_with_exception(func):
-    attempts = 3
-    delay = 1
+    @contextmanager
+    def connection(self):
+        if self.pid != os.getpid():
+            self.reset()
+        self.start_pinger()
+        try:
+            connection = self.slots.get(timeout=time_left(self.timeout))
+        except Empty:
+            raise PoolError("No free connection in the pool")
+        try:
+            if connection is None:
+                connection = self.connect()
+            # An attempt doesn't outlive the deadline of the store call
+            self.set_timeout(connection, time_left(self.timeout))
+            yield connection
+        except (tarantool.error.NetworkError, socket.error):
+            # Drop only the broken connection, the others are still usable
+            if connection is not None:
+                self.close(connection)
+                connection = None
+            raise
+        finally:
+            if connection is not None:
+                self.set_timeout(connection, self.timeout)
+            self.slots.put(connection)
+
+    def set_timeout(self, connection, timeout):
+        sock = getattr(connection, '_socket', None)
+        if sock is not None:
+            sock.settimeout(timeout)
+
+    def start_pinger(self):
+        if self.pinger is not None or not self.ping_interval:
+            return
+        with self.lock:
+            if self.pinger is None:
+                self.pinger = threading.Thread(target=self.ping_forever)
+                self.pinger.daemon = True
+                self.pinger.start()
+
+    def ping_forever(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(self.ping_interval)
+            self.ping()
 
-    def wrapper(*args, **kwargs):
-        for attempt in range(attempts):
+    def ping(self):
+        """Check idle connections and try to return dead replicas."""
+        # Slots are a stack, a connection put back would be taken again,
+        # so all idle connections are taken first
+        idle = []
+        for _ in range(self.size):
             try:
-                return func(*args, **kwargs)
-            except Exception:
-                time.sleep(delay * attempt)
-                args[0].connect()
+                idle.append(self.slots.get_nowait())
+            except Empty:
+                break
+        for index, connection in enumerate(idle):
+            if connection is not None:
+                try:
+                    connection.ping(notime=True)
+                except Exception:
+                    self.close(connection)
+                    idle[index] = None
+        for connection in reversed(idle):
+            self.slots.put(connection)
+
+        for address, alive in list(self.alive.items()):
+            if alive:
                 continue
-        raise Exception
-    return wrapper
+            try:
+                self.open(address).close()
+                self.alive[address] = True
+            except Exception:
+                pass
+
 
+class LocalCache(object):
+    """
+    In-process LRU cache, every entry keeps the time it lives till.
+    It is safe to share between threads.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-class Store(object):
-    def __init__(self):
-        self.server = ''
-        self.scoring_space = ''
-        self.interests_space = ''
-        self.connect()
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            value, live_till = item
+            if time.time() >= live_till:
+                self.misses += 1
+                self.evictions += 1
+                return None
+            self.items[key] = item
+            self.hits += 1
+            return value
+
+    def set(self, key, value, live_till):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, live_till)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+                self.evictions += 1
 
+    @property
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class BaseStore(object):
+    """
+    Interface of a store used by the scoring functions.
+    Scores are kept in a cache with expiry time, interests are kept
+    by a client key like "i:1".
+    """
     @property
     def is_alive(self):
-        try:
-            self.scoring_space.select('0')
-            return True
-        except:
-            return False
+        return True
 
-    @with_reconnect
-    def connect(self):
-        self.server = tarantool.connection.Connection(
-            host="tarantool", port=3301
-        )
+    def cache_get(self, key):
+        """Return a cached score or None."""
+        raise NotImplementedError
+
+    def cache_set(self, key, score, cache_time):
+        """Cache a score for cache_time seconds."""
+        raise NotImplementedError
+
+    def cache_get_many(self, keys):
+        """Return {key: score} for the given keys which are cached."""
+        result = {}
+        for key in keys:
+            score = self.cache_get(key)
+            if score is not None:
+                result[key] = score
+        return result
+
+    def cache_set_many(self, scores, cache_time):
+        """Cache {key: score} for cache_time seconds."""
+        for key, score in scores.items():
+            self.cache_set(key, score, cache_time)
+
+    def get(self, cid):
+        """Return {cid: interests} or None."""
+        raise NotImplementedError
+
+    def get_many(self, cids):
+        """Return {cid: interests} for the given keys which exist."""
+        raise NotImplementedError
+
+    def set(self, cid, interests):
+        """Save interests of a client."""
+        raise NotImplementedError
+
+    def set_many(self, records):
+        """Save (cid, interests) records."""
+        for cid, interests in records:
+            self.set(cid, interests)
 
-        self.scoring_space = self.server.space('scoring')
-        self.interests_space = self.server.space('interests')
+    def truncate(self, space):
+        """Remove all records of the "scoring" or "interests" space."""
+        raise NotImplementedError
 
-    @try_reconnect
+
+class TarantoolStore(BaseStore):
+    def __init__(self, host="tarantool", port=3301, pool_size=4,
+                 replicas=(), timeout=1, ping_interval=5,
+                 local_cache_size=0, retry_policy=None):
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.pool = ConnectionPool(
+            [(host, port)] + list(replicas), size=pool_size,
+            timeout=timeout, ping_interval=ping_interval)
+        self.local_cache = None
+        if local_cache_size:
+            self.local_cache = LocalCache(local_cache_size)
+
+    @property
+    def is_alive(self):
+        return self.pool.is_alive
+
+    # The local cache is read and written outside the retry policy, so it
+    # serves hits while the circuit is open, only Tarantool is retried
     def cache_get(self, key):
-        record = self.scoring_space.select(key)
+        if self.local_cache is not None:
+            score = self.local_cache.get(key)
+            if score is not None:
+                return score
+        record = self._cache_get(key)
+        if record is None:
+            return None
+        score, live_till = record
+        if self.local_cache is not None:
+            self.local_cache.set(key, score, live_till)
+        return score
+
+    @with_silent_retry
+    def _cache_get(self, key):
+        # Expired records are removed by Tarantool itself,
+        # here we only skip the ones which are not removed yet
+        with self.pool.connection() as server:
+            record = server.select('scoring', key)
         if record.data:
-            live_till = float(record.data[0][2])
+            live_till = record.data[0][2]
             if time.time() < live_till:
-                return record.data[0][1]
-            self.scoring_space.delete(key)
+                return record.data[0][1], live_till
 
-    @try_reconnect
     def cache_set(self, key, score, cache_time):
+        live_till = time.time() + cache_time
+        if self.local_cache is not None:
+            self.local_cache.set(key, score, live_till)
+        self._cache_set(key, score, live_till)
+
+    @with_silent_retry
+    def _cache_set(self, key, score, live_till):
         try:
-            live_till = str(time.time() + cache_time)
-            self.scoring_space.insert((key, score, live_till))
+            with self.pool.connection() as server:
+                server.replace('scoring', (key, score, live_till))
+        except tarantool.error.NetworkError:
+            raise
         except tarantool.error.DatabaseError:
             pass
 
-    @try_reconnect_with_exception
+    def cache_get_many(self, keys):
+        result = {}
+        if self.local_cache is not None:
+            for key in keys:
+                score = self.local_cache.get(key)
+                if score is not None:
+                    result[key] = score
+            keys = [key for key in keys if key not in result]
+        if keys:
+            records = self._cache_get_many(keys) or {}
+            for key, (score, live_till) in records.items():
+                if self.local_cache is not None:
+                    self.local_cache.set(key, score, live_till)
+                result[key] = score
+        return result
+
+    @with_silent_retry
+    def _cache_get_many(self, keys):
+        with self.pool.connection() as server:
+            response = server.call('scoring_get_many', [keys])
+        return dict(response.data[0]) if response.data else {}
+
+    def cache_set_many(self, scores, cache_time):
+        live_till = time.time() + cache_time
+        records = []
+        for key, score in scores.items():
+            if self.local_cache is not None:
+                self.local_cache.set(key, score, live_till)
+            records.append((key, score, live_till))
+        self._cache_set_many(records)
+
+    @with_silent_retry
+    def _cache_set_many(self, records):
+        with self.pool.connection() as server:
+            server.call('scoring_set_many', [records])
+
+    @with_retry
     def get(self, cid):
-        try:
-            record = self.interests_space.select(cid)
-            if record:
-                return json.dumps({cid: record[0][1]})
-        except:
-            raise Exception
+        with self.pool.connection() as server:
+            record = server.select('interests', cid)
+        if record:
+            return {cid: record[0][1]}
+
+    @with_retry
+    def get_many(self, cids):
+        """Return interests of all the given keys with one call."""
+        with self.pool.connection() as server:
+            response = server.call('interests_get_many', [list(cids)])
+        return dict(response.data[0]) if response.data else {}
+
+    @with_retry
+    def set(self, cid, interests):
+        with self.pool.connection() as server:
+            server.replace('interests', (cid, interests))
+
+    @with_retry
+    def set_many(self, records):
+        """Save (cid, interests) records with one call."""
+        with self.pool.connection() as server:
+            server.call('interests_set_many',
+                        [[list(record) for record in records]])
+
+    @with_retry
+    def truncate(self, space):
+        with self.pool.connection() as server:
+            server.call('space_truncate', [space])
 
     def set_init_data(self):
         try:
             self._clean_base()
-            self.scoring_space.insert((
-                'uid:8a82ea01ffe65005c3660d227e1fb44e',
-                10.0,
-                time.time() + 10
-            ))
-            self.interests_space.insert(('i:1', ['auto', 'books']))
-            self.interests_space.insert(('i:2', ['garden', 'birds']))
-            self.interests_space.insert(('i:3', ['forest', 'airplane']))
-        except:
+            self.cache_set('uid:8a82ea01ffe65005c3660d227e1fb44e', 10.0, 10)
+            self.set_many([
+                ('i:1', ['auto', 'books']),
+                ('i:2', ['garden', 'birds']),
+                ('i:3', ['forest', 'airplane']),
+            ])
+        except (StoreError, tarantool.error.DatabaseError):
             pass
 
     def _clean_base(self):
+        self.truncate('scoring')
+        self.truncate('interests')
+
+
+class MemoryStore(BaseStore):
+    """Store in memory of the process."""
+    def __init__(self, cache_size=100000):
+        self.cache = LocalCache(cache_size)
+        self.interests = {}
+
+    def cache_get(self, key):
+        return self.cache.get(key)
+
+    def cache_set(self, key, score, cache_time):
+        self.cache.set(key, score, time.time() + cache_time)
+
+    def get(self, cid):
+        interests = self.interests.get(cid)
+        if interests is not None:
+            return {cid: interests}
+
+    def get_many(self, cids):
+        return dict((cid, self.interests[cid]) for cid in cids
+                    if cid in self.interests)
+
+    def set(self, cid, interests):
+        self.interests[cid] = interests
+
+    def truncate(self, space):
+        if space == 'scoring':
+            self.cache = LocalCache(self.cache.size)
+        elif space == 'interests':
+            self.interests = {}
+        else:
+            raise ValueError("Unknown space %s" % space)
+
+
+class SharedMemoryStore(BaseStore):
+    """
+    Store in a memory mapped file which worker processes on the same host
+    share. It is a hash table of fixed size slots with linear probing,
+    when there is no free slot for a key the cached score which expires
+    first is overwritten. Interests never expire and are never
+    overwritten by other keys, TableFullError is raised instead.
+    """
+    value_size = 438
+    slot = struct.Struct('<d64sH%ds' % value_size)
+    probes = 16
+
+    def __init__(self, path, size=65536):
+        self.path = path
+        self.size = size
+        self.pid = None
+        self.open()
+
+    def open(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        length = self.slot.size * self.size
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
         try:
-            records = self.scoring_space.select()
-            for rec in records:
-                self.scoring_space.delete(rec[0])
-
-            records = self.interests_space.select()
-            for rec in records:
-                self.interests_space.delete(rec[0])
-        except:
+            if os.fstat(self.fd).st_size < length:
+                os.ftruncate(self.fd, length)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mmap = mmap.mmap(self.fd, length)
+
+    @contextmanager
+    def locked(self, operation):
+        # flock works between processes only if every process opened
+        # the file itself, so the file is opened again after fork
+        if self.pid != os.getpid():
+            os.close(self.fd)
+            self.open()
+        with self.lock:
+            fcntl.flock(self.fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def slot_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if len(key) > 64:
+            key = hashlib.sha1(key).hexdigest()
+        return key
+
+    def indexes(self, key):
+        start = zlib.crc32(key) & 0xffffffff
+        for i in range(self.probes):
+            yield (start + i) % self.size
+
+    def read(self, key):
+        key = self.slot_key(key)
+        with self.locked(fcntl.LOCK_SH):
+            for index in self.indexes(key):
+                live_till, slot_key, length, value = self.slot.unpack_from(
+                    self.mmap, index * self.slot.size)
+                slot_key = slot_key.rstrip('\0')
+                if not slot_key:
+                    return None
+                if slot_key == key:
+                    if time.time() < live_till:
+                        return serialization.loads(value[:length])
+                    return None
+
+    def write(self, key, value, live_till):
+        key = self.slot_key(key)
+        value = serialization.dumps(value)
+        if len(value) > self.value_size:
+            raise ValueError("Value is too large: %s bytes" % len(value))
+        with self.locked(fcntl.LOCK_EX):
+            self.put(key, value, live_till, time.time())
+
+    def put(self, key, value, live_till, now):
+        """Write an encoded value, the table must be locked."""
+        target = evicted = evicted_live_till = None
+        for index in self.indexes(key):
+            slot_live_till, slot_key = struct.unpack_from(
+                '<d64s', self.mmap, index * self.slot.size)
+            slot_key = slot_key.rstrip('\0')
+            if slot_key == key:
+                target = index
+                break
+            if not slot_key:
+                # There are no keys after an empty slot
+                if target is None:
+                    target = index
+                break
+            if slot_live_till <= now:
+                if target is None:
+                    target = index
+            elif slot_live_till != float('inf') and (
+                    evicted is None or slot_live_till < evicted_live_till):
+                evicted, evicted_live_till = index, slot_live_till
+        if target is None:
+            target = evicted
+        if target is None:
+            raise TableFullError("No free slot for %s" % key)
+        self.slot.pack_into(self.mmap, target * self.slot.size,
+                            live_till, key, len(value), value)
+
+    def truncate(self, space):
+        """
+        Cached scores expire and interests don't, so the space is told by
+        the lifetime. The table is cleared and live entries of the other
+        space are written again, so no key is left after an empty slot.
+        """
+        if space not in ('scoring', 'interests'):
+            raise ValueError("Unknown space %s" % space)
+        interests = space == 'interests'
+        now = time.time()
+        with self.locked(fcntl.LOCK_EX):
+            kept = []
+            for index in range(self.size):
+                live_till, slot_key, length, value = self.slot.unpack_from(
+                    self.mmap, index * self.slot.size)
+                slot_key = slot_key.rstrip('\0')
+                if slot_key and live_till > now and \
+                        (live_till == float('inf')) != interests:
+                    kept.append((slot_key, value[:length], live_till))
+            self.mmap[:] = '\0' * len(self.mmap)
+            for key, value, live_till in kept:
+                self.put(key, value, live_till, now)
+
+    def cache_get(self, key):
+        return self.read(key)
+
+    def cache_set(self, key, score, cache_time):
+        try:
+            self.write(key, score, time.time() + cache_time)
+        except TableFullError:
+            # The score is not cached, as when the cache is unavailable
             pass
+
+    def get(self, cid):
+        interests = self.read(cid)
+        if interests is not None:
+            return {cid: interests}
+
+    def get_many(self, cids):
+        result = {}
+        for cid in cids:
+            interests = self.read(cid)
+            if interests is not None:
+                result[cid] = interests
+        return result
+
+    def set(self, cid, interests):
+        self.write(cid, interests, float('inf'))
+
+
+BACKENDS = {
+    'tarantool': TarantoolStore,
+    'memory': MemoryStore,
+    'shared': SharedMemoryStore,
+}
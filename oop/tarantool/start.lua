@@ -1,5 +1,12 @@
 #!/usr/bin/tarantool
 
+local fiber = require('fiber')
+
+-- Expired scores are removed in batches of EXPIRE_BATCH tuples
+-- every EXPIRE_INTERVAL seconds
+local EXPIRE_BATCH = 1000
+local EXPIRE_INTERVAL = 1
+
 box.cfg {
     listen = 3301
 }
@@ -11,3 +18,120 @@ box.once('scoring_space', function()
 	i:create_index('primary', {unique = true, parts = {1, 'STR'}})
 	end
 )
+
+box.once('interests_get_many', function()
+	box.schema.func.create('interests_get_many')
+	box.schema.user.grant('guest', 'execute', 'function', 'interests_get_many')
+	end
+)
+
+-- Return interests for all the given keys in one call
+function interests_get_many(keys)
+	local result = {}
+	for _, key in ipairs(keys) do
+		local record = box.space.interests:get(key)
+		if record ~= nil then
+			result[key] = record[2]
+		end
+	end
+	return result
+end
+
+box.once('scoring_live_till', function()
+	-- live_till used to be a string, cached scores are safe to drop
+	box.space.scoring:truncate()
+	box.space.scoring:create_index('live_till', {
+		unique = false, parts = {3, 'number'}
+	})
+	end
+)
+
+local function expire_scores()
+	local expired = {}
+	local index = box.space.scoring.index.live_till
+	for _, record in index:pairs(fiber.time(), {iterator = 'LT'}) do
+		table.insert(expired, record[1])
+		if #expired >= EXPIRE_BATCH then
+			break
+		end
+	end
+	box.begin()
+	for _, key in ipairs(expired) do
+		box.space.scoring:delete(key)
+	end
+	box.commit()
+	return #expired
+end
+
+fiber.create(function()
+	fiber.name('expire_scores')
+	while true do
+		local ok, count = pcall(expire_scores)
+		if not ok then
+			box.rollback()
+		end
+		if ok and count >= EXPIRE_BATCH then
+			fiber.yield()
+		else
+			fiber.sleep(EXPIRE_INTERVAL)
+		end
+	end
+end)
+
+box.once('scoring_many', function()
+	for _, name in ipairs({'scoring_get_many', 'scoring_set_many'}) do
+		box.schema.func.create(name)
+		box.schema.user.grant('guest', 'execute', 'function', name)
+	end
+	end
+)
+
+-- Return {key = {score, live_till}} of the given keys which are not expired
+function scoring_get_many(keys)
+	local result = {}
+	local now = fiber.time()
+	for _, key in ipairs(keys) do
+		local record = box.space.scoring:get(key)
+		if record ~= nil and record[3] > now then
+			result[key] = {record[2], record[3]}
+		end
+	end
+	return result
+end
+
+-- Save {key, score, live_till} records in one transaction
+function scoring_set_many(records)
+	box.begin()
+	for _, record in ipairs(records) do
+		box.space.scoring:replace(record)
+	end
+	box.commit()
+end
+
+box.once('interests_bulk', function()
+	for _, name in ipairs({'interests_set_many', 'space_truncate'}) do
+		box.schema.func.create(name)
+		box.schema.user.grant('guest', 'execute', 'function', name)
+	end
+	end
+)
+
+-- Save {key, interests} records in one transaction
+function interests_set_many(records)
+	box.begin()
+	for _, record in ipairs(records) do
+		box.space.interests:replace(record)
+	end
+	box.commit()
+	return #records
+end
+
+local TRUNCATABLE = {scoring = true, interests = true}
+
+-- Remove all records of a space at once
+function space_truncate(name)
+	if not TRUNCATABLE[name] then
+		error('Space ' .. tostring(name) .. ' can not be truncated')
+	end
+	box.space[name]:truncate()
+end
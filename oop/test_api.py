@@ -1,8 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import httplib
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+from StringIO import StringIO
+import threading
+import time
 import unittest
+import urllib2
+
 import api
+import asynclog
+import bulk
+import jsonstream
+import load_interests
+import metrics
+import scoring
+import serialization
+import store
 
 try:
     import mock
@@ -34,6 +55,22 @@ class TestFields(unittest.TestCase):
             field.clean('12.12.1954'), api.datetime(1954, 12, 12, 0, 0)
         )
 
+    @cases(['1.2.1990', u'01.02.1990', '01.02.1990'])
+    def test_parse_date(self, value):
+        self.assertEqual(api.parse_date(value), api.datetime(1990, 2, 1))
+
+    @cases(['31.02.1990', '01.02.1990\n', '01.02.90', 19900201])
+    def test_bad_parse_date(self, value):
+        with self.assertRaises((ValueError, TypeError)):
+            api.parse_date(value)
+
+    @cases([(api.datetime(2025, 3, 1), api.datetime(1954, 3, 1)),
+            (api.datetime(2027, 2, 28), api.datetime(1956, 2, 29)),
+            (api.datetime(2028, 2, 29), api.datetime(1957, 2, 28))])
+    def test_birthday_cutoff(self, value):
+        today, cutoff = value
+        self.assertEqual(api.get_birthday_cutoff(today), cutoff)
+
     @cases([1, 's', [], ['1', 2, 3], ['1', '2', '3'], '', ()])
     def test_bad_client_ids_field(self, value):
         field = api.ClientIDsField()
@@ -124,6 +161,18 @@ class TestClientsInterestsRequest(unittest.TestCase):
         request = api.ClientsInterestsRequest(value)
         self.assertEqual(request.is_valid(), True)
 
+    def test_get_response(self):
+        store = FakeStore()
+        store.interests = {'i:1': ['auto', 'books'], 'i:3': ['forest']}
+        request = api.ClientsInterestsRequest({'client_ids': [1, 2, 3]})
+        ctx = {}
+        self.assertEqual(
+            request.get_response(ctx, store),
+            ({'1': ['auto', 'books'], '2': [], '3': ['forest']}, 200)
+        )
+        self.assertEqual(ctx['nclients'], 3)
+        self.assertEqual(store.get_many_calls, 1)
+
 
 # @unittest.skip("Skip TestOnlineScoreRequest")
 class TestOnlineScoreRequest(unittest.TestCase):
@@ -151,6 +200,73 @@ class TestOnlineScoreRequest(unittest.TestCase):
         request = api.OnlineScoreRequest(value)
         self.assertEqual(request.is_valid(), True)
 
+    def test_errors(self):
+        request = api.OnlineScoreRequest({
+            'phone': '89175002040', 'email': '1@1', 'gender': 5})
+        self.assertEqual(set(request.errors), set([
+            'phone', 'gender', 'OnlineScoreRequest']))
+        self.assertEqual(request.errors['phone'], "Invalid format. "
+                                                  "Must start with 7")
+        self.assertEqual(request.errors['OnlineScoreRequest'], {
+            'pair_not_exist': "Invalid set of fields (('phone', 'email'), "
+                              "('first_name', 'last_name'), "
+                              "('gender', 'birthday'))"})
+
+    def test_nullable_error(self):
+        request = api.MethodRequest({
+            'account': '', 'login': 'a', 'token': '', 'method': '',
+            'arguments': {}})
+        self.assertEqual(request.errors, {
+            'method': 'This field must not be an empty.'})
+        request = api.MethodRequest({'login': 'a', 'token': '',
+                                     'arguments': {}})
+        self.assertEqual(request.errors, {
+            'MethodRequest': 'This field <method> is required.'})
+
+    def test_slots(self):
+        request = api.OnlineScoreRequest({'first_name': 'a'})
+        self.assertFalse(hasattr(request, '__dict__'))
+        self.assertEqual((request.first_name, request.last_name), ('a', ''))
+        with self.assertRaises(AttributeError):
+            request.unknown = 1
+
+    def test_not_empty_fields(self):
+        request = api.OnlineScoreRequest({
+            'first_name': 'a', 'last_name': 'b', 'email': ''})
+        self.assertEqual(
+            sorted(request.not_empty_fields), ['first_name', 'last_name'])
+
+
+# @unittest.skip("Skip TestCheckAuth")
+class TestCheckAuth(unittest.TestCase):
+    def setUp(self):
+        api.verified_tokens = api.LocalCache(api.AUTH_CACHE_SIZE)
+
+    def test_admin(self):
+        token = api.hashlib.sha512(api.datetime.now().strftime(
+            "%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        request = api.MethodRequest({
+            "login": "admin", "token": token, "arguments": {},
+            "method": "online_score"})
+        self.assertTrue(api.check_auth(request))
+        self.assertTrue(api.check_auth(request))
+
+    @cases(['', 'abc', 42, None, [], u'\u0444'])
+    def test_bad_token(self, token):
+        request = api.MethodRequest({
+            "account": "horns&hoofs", "login": "h&f", "token": token,
+            "arguments": {}, "method": "online_score"})
+        self.assertFalse(api.check_auth(request))
+
+    def test_user(self):
+        token = api.hashlib.sha512("horns&hoofsh&f" + api.SALT).hexdigest()
+        request = api.MethodRequest({
+            "account": "horns&hoofs", "login": "h&f", "token": unicode(token),
+            "arguments": {}, "method": "online_score"})
+        self.assertTrue(api.check_auth(request))
+        self.assertTrue(api.check_auth(request))
+        self.assertEqual(api.verified_tokens.stats['hits'], 1)
+
 
 # @unittest.skip("Skip TestMethodHandler")
 class TestMethodHandler(unittest.TestCase):
@@ -307,6 +423,179 @@ class TestMethodHandler(unittest.TestCase):
             )
 
 
+# @unittest.skip("Skip TestBatchHandler")
+class TestBatchHandler(unittest.TestCase):
+    def method(self, method, arguments, login="h&f"):
+        token = api.hashlib.sha512("horns&hoofs" + login + api.SALT)
+        return {"account": "horns&hoofs", "login": login,
+                "token": token.hexdigest(), "method": method,
+                "arguments": arguments}
+
+    def test_batch(self):
+        fake_store = FakeStore()
+        fake_store.interests = {'i:1': ['auto'], 'i:2': ['books']}
+        person = {"first_name": "a", "last_name": "b"}
+        cached = {"first_name": "c", "last_name": "d", "phone": "79175002040"}
+        fake_store.cache_set(scoring.score_key('c', 'd'), 10.0, 60)
+        body = [
+            self.method("online_score", person),
+            dict(self.method("online_score", person), token="bad"),
+            self.method("clients_interests", {"client_ids": [1, 3]}),
+            self.method("online_score", cached),
+            "not a request",
+            self.method("clients_interests", {"client_ids": [2, 1]}),
+            self.method("online_score", {"first_name": "a"}),
+        ]
+        ctx = {}
+        response, code = api.batch_handler(
+            {"body": body, "headers": {}}, ctx, fake_store)
+        self.assertEqual(code, 200)
+        self.assertEqual([r["code"] for r in response],
+                         [200, 403, 200, 200, 422, 200, 422])
+        self.assertEqual(response[0]["response"], {"score": 0.5})
+        self.assertEqual(response[2]["response"], {"1": ["auto"], "3": []})
+        self.assertEqual(response[3]["response"], {"score": 10.0})
+        self.assertEqual(response[5]["response"],
+                         {"2": ["books"], "1": ["auto"]})
+        self.assertEqual(ctx["batch"], 7)
+        self.assertEqual(fake_store.get_many_calls, 1)
+        self.assertEqual(fake_store.cache_calls, 2)
+
+    def test_not_list(self):
+        self.assertEqual(
+            api.batch_handler({"body": {}, "headers": {}}, {}, FakeStore()),
+            ('Invalid Request', 422))
+
+    def test_get_scores(self):
+        people = [
+            {"phone": "79175002040", "email": "a@b", "first_name": "a",
+             "last_name": "b", "birthday": "01.01.1990", "gender": 1},
+            {"phone": "", "email": "a@b", "first_name": "x",
+             "last_name": "", "birthday": "", "gender": ""},
+            {"phone": "", "email": "", "first_name": "a",
+             "last_name": "b", "birthday": "01.01.1990", "gender": ""},
+            {"phone": "", "email": "", "first_name": "z",
+             "last_name": "", "birthday": "", "gender": ""},
+            {"phone": "", "email": "a@b", "first_name": "z",
+             "last_name": "", "birthday": "", "gender": ""},
+        ]
+        scalar_store = FakeStore()
+        expected = [api.get_score(scalar_store, **p) for p in people]
+        self.assertEqual(api.get_scores(FakeStore(), people), expected)
+
+
+# @unittest.skip("Skip TestCalculateScores")
+class TestCalculateScores(unittest.TestCase):
+    fields = ('phone', 'email', 'birthday', 'gender', 'first_name',
+              'last_name')
+
+    def test_calculate_scores(self):
+        # every combination of filled fields
+        people = [dict((name, 'x' if mask & (1 << i) else '')
+                       for i, name in enumerate(self.fields))
+                  for mask in range(1 << len(self.fields))]
+        columns = [[bool(person[name]) for person in people]
+                   for name in self.fields]
+        self.assertEqual(
+            scoring.calculate_scores(*columns),
+            [scoring.calculate_score(**person) for person in people])
+
+    def test_score_keys(self):
+        people = [('a', 'b', '01.01.1990'), (None, '', None), (u'c', 'd', '')]
+        self.assertEqual(
+            scoring.score_keys(*zip(*people)),
+            [scoring.score_key(*person) for person in people])
+
+
+# @unittest.skip("Skip TestBulk")
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        bulk.store = FakeStore()
+
+    def test_score_batch(self):
+        records = bulk.read_json_lines(StringIO(
+            '{"id": "a", "phone": "79175002040", "email": "a@b"}\n'
+            '\n'
+            '{"first_name": "x"}\n'
+            '[1]\n'))
+        batches = list(bulk.read_batches(records, 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        results = bulk.score_batch(batches[0]) + bulk.score_batch(batches[1])
+        self.assertEqual([(r["id"], r["code"]) for r in results],
+                         [("a", 200), (2, 422), (3, 422)])
+        self.assertEqual(results[0]["score"], 3.0)
+        self.assertEqual(bulk.store.cache_calls, 2)
+
+    def test_malformed_line(self):
+        records = bulk.read_json_lines(StringIO(
+            '{"id": "a", "phone": "79175002040"\n'
+            '{"id": "b", "phone": "79175002040", "email": "a@b"}\n'))
+        results = bulk.score_batch(list(bulk.read_batches(records, 10))[0])
+        self.assertEqual([(r["id"], r["code"]) for r in results],
+                         [(1, 400), ("b", 200)])
+        self.assertTrue(results[0]["error"])
+
+    def test_read_csv(self):
+        records = list(bulk.read_csv(StringIO(
+            'id,first_name,last_name,birthday,gender\n'
+            '1,x,y,01.01.1990,1\n')))
+        self.assertEqual(records, [{
+            'id': '1', 'first_name': 'x', 'last_name': 'y',
+            'birthday': '01.01.1990', 'gender': 1}])
+
+
+# @unittest.skip("Skip TestLoadInterests")
+class TestLoadInterests(unittest.TestCase):
+    def test_read_json_lines(self):
+        records = load_interests.read_json_lines(StringIO(
+            '{"cid": 1, "interests": ["auto", "books"]}\n\n'
+            '{"cid": 2, "interests": []}\n'))
+        self.assertEqual(list(records), [
+            ('i:1', ['auto', 'books']), ('i:2', [])])
+
+    def test_skip_bad_json_lines(self):
+        records = load_interests.read_json_lines(StringIO(
+            '{"cid": 1, "interests": ["auto"]\n'
+            '{"interests": ["auto"]}\n'
+            '{"cid": 2}\n'
+            '[3]\n'
+            '{"cid": 4, "interests": "auto"}\n'
+            '{"cid": 5, "interests": ["books"]}\n'))
+        self.assertEqual(list(records), [('i:5', ['books'])])
+
+    def test_read_csv(self):
+        records = load_interests.read_csv(StringIO(
+            'cid,interests\n1,auto;books\n2,\n,auto\n'))
+        self.assertEqual(list(records), [
+            ('i:1', ['auto', 'books']), ('i:2', [])])
+
+    def test_load(self):
+        memory_store = store.MemoryStore()
+        memory_store.set('i:0', ['old'])
+        memory_store.truncate('interests')
+        records = [('i:%s' % i, [str(i)]) for i in range(25)]
+        total = load_interests.load(memory_store, iter(records),
+                                    batch_size=10, workers=2)
+        self.assertEqual(total, 25)
+        self.assertEqual(memory_store.interests, dict(records))
+
+    def test_failed_batch(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        shared_store = store.SharedMemoryStore(
+            os.path.join(directory, 'store'), size=64)
+        records = [('i:%s' % i, [str(i)]) for i in range(25)]
+        records[12] = ('i:12', ['x' * 500])
+        progress = load_interests.Progress(0)
+        total = load_interests.load(shared_store, iter(records),
+                                    batch_size=10, workers=2,
+                                    progress=progress)
+        self.assertEqual(total, 15)
+        self.assertEqual((progress.skipped_batches, progress.skipped),
+                         (1, 10))
+        self.assertEqual(shared_store.get('i:24'), {'i:24': ['24']})
+
+
 # @unittest.skip("Skip TestScoring")
 class TestScoring(unittest.TestCase):
     def setUp(self):
@@ -404,5 +693,766 @@ class TestInterests(unittest.TestCase):
                 value.get('result')
 
 
+class FakeConnection(object):
+    def __init__(self, address):
+        self.address = address
+        self.closed = False
+        self.pings = 0
+
+    def ping(self, notime=False):
+        self.pings += 1
+
+    def close(self):
+        self.closed = True
+
+
+# @unittest.skip("Skip TestObjectScanner")
+class TestObjectScanner(unittest.TestCase):
+    def scan(self, data, size=1):
+        scanner = jsonstream.ObjectScanner(stop_keys=('arguments',))
+        for i in range(0, len(data), size):
+            scanner.feed(data[i:i + size], complete=i + size >= len(data))
+        return scanner
+
+    def test_members(self):
+        scanner = self.scan('{"login": "h&f", "n": 123, "ok": true, '
+                            '"arguments": {"a": 1}, "token": "x"}')
+        self.assertTrue(scanner.stopped)
+        self.assertEqual(scanner.members,
+                         {'login': 'h&f', 'n': 123, 'ok': True})
+
+    def test_done(self):
+        scanner = self.scan(' { "a" : [1, 2], "b": {} } ', size=3)
+        self.assertFalse(scanner.stopped)
+        self.assertEqual(scanner.members, {'a': [1, 2], 'b': {}})
+
+    @cases(['[1, 2]', '{"a" 1}', '{"a": 1,}', '{"a": 1', '{"a": tru}'])
+    def test_malformed(self, data):
+        with self.assertRaises(ValueError):
+            self.scan(data)
+
+
+# @unittest.skip("Skip TestSerialization")
+class TestSerialization(unittest.TestCase):
+    @cases([{"code": 200, "response": {"score": 5.0}},
+            {"1": [u"books", u"\u0444"]}, [], "text"])
+    def test_round_trip(self, value):
+        self.assertEqual(
+            serialization.loads(serialization.dumps(value)), value)
+
+
+# @unittest.skip("Skip TestConnectionPool")
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = store.ConnectionPool(
+            [('master', 1), ('replica', 2)], size=2, timeout=0.01,
+            ping_interval=0)
+        self.down = set()
+        self.pool.open = self.open
+
+    def open(self, address):
+        if address in self.down:
+            raise store.tarantool.error.NetworkError('down')
+        return FakeConnection(address)
+
+    def test_failover(self):
+        self.down.add(('master', 1))
+        with self.pool.connection() as connection:
+            self.assertEqual(connection.address, ('replica', 2))
+        self.assertFalse(self.pool.alive[('master', 1)])
+        self.assertTrue(self.pool.is_alive)
+
+    def test_bounded(self):
+        with self.pool.connection(), self.pool.connection():
+            with self.assertRaises(store.PoolError):
+                with self.pool.connection():
+                    pass
+
+    def test_broken_connection(self):
+        with self.pool.connection() as first:
+            pass
+        with self.assertRaises(store.tarantool.error.NetworkError):
+            with self.pool.connection() as connection:
+                self.assertIs(connection, first)
+                raise store.tarantool.error.NetworkError('lost')
+        self.assertTrue(first.closed)
+        with self.pool.connection() as connection:
+            self.assertIsNot(connection, first)
+
+    def test_lazy(self):
+        tarantool_store = store.TarantoolStore(host='nowhere')
+        self.assertEqual(tarantool_store.pool.alive, {('nowhere', 3301): None})
+
+    def test_ping_all_idle_connections(self):
+        pool = store.ConnectionPool([('master', 1)], size=3, ping_interval=0)
+        pool.open = self.open
+        with pool.connection() as first, pool.connection() as second, \
+                pool.connection() as third:
+            pass
+        pool.ping()
+        self.assertEqual([first.pings, second.pings, third.pings], [1, 1, 1])
+        with pool.connection() as connection:
+            self.assertIs(connection, first)
+
+    def test_silent_server(self):
+        # The server accepts connections but never sends the greeting
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        address = listener.getsockname()
+        pool = store.ConnectionPool([address], size=1, timeout=5,
+                                    ping_interval=0)
+        tarantool_store = store.TarantoolStore(
+            host=address[0], port=address[1], ping_interval=0)
+        tarantool_store.pool = pool
+        started = time.time()
+        with store.request_deadline(0.3):
+            self.assertIsNone(tarantool_store.cache_get('uid:1'))
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(pool.slots.qsize(), 1)
+
+    def test_ping(self):
+        self.down.add(('master', 1))
+        with self.pool.connection():
+            pass
+        self.down.clear()
+        self.pool.ping()
+        self.assertTrue(self.pool.alive[('master', 1)])
+
+
+# @unittest.skip("Skip TestRetryPolicy")
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = store.RetryPolicy(
+            attempts=3, delay=0, failure_threshold=2, reset_timeout=60)
+        self.calls = 0
+
+    def fail(self, error):
+        self.calls += 1
+        raise error
+
+    def test_transport_error(self):
+        with self.assertRaises(store.StoreError):
+            self.policy.call(self.fail, store.socket.error())
+        self.assertEqual(self.calls, 3)
+
+    def test_logic_error(self):
+        with self.assertRaises(KeyError):
+            self.policy.call(self.fail, KeyError())
+        self.assertEqual(self.calls, 1)
+
+    def test_circuit_breaker(self):
+        for _ in range(2):
+            with self.assertRaises(store.StoreError):
+                self.policy.call(self.fail, store.PoolError())
+        self.assertTrue(self.policy.is_open)
+        with self.assertRaises(store.StoreError):
+            self.policy.call(self.fail, store.PoolError())
+        self.assertEqual(self.calls, 6)
+
+    def test_local_cache_with_open_circuit(self):
+        tarantool_store = store.TarantoolStore(
+            host='nowhere', ping_interval=0, local_cache_size=10,
+            retry_policy=self.policy)
+        self.policy.opened_at = time.time()
+        tarantool_store.cache_set('uid:1', 4.5, 60)
+        self.assertEqual(tarantool_store.cache_get('uid:1'), 4.5)
+        self.assertEqual(
+            tarantool_store.cache_get_many(['uid:1', 'uid:2']),
+            {'uid:1': 4.5})
+        with store.request_deadline(-1):
+            self.assertEqual(tarantool_store.cache_get('uid:1'), 4.5)
+
+    def test_deadline(self):
+        policy = store.RetryPolicy(attempts=10, delay=1, deadline=0.1)
+        with self.assertRaises(store.StoreError):
+            policy.call(self.fail, store.socket.error())
+        self.assertLess(self.calls, 10)
+
+    def test_request_deadline(self):
+        policy = store.RetryPolicy(attempts=10, delay=1, deadline=60)
+        with store.request_deadline(0.1):
+            with self.assertRaises(store.StoreError):
+                policy.call(self.fail, store.socket.error())
+        self.assertLess(self.calls, 10)
+
+    def test_request_deadline_exceeded(self):
+        with store.request_deadline(-1):
+            with self.assertRaises(store.StoreError):
+                self.policy.call(self.fail, store.socket.error())
+        self.assertEqual((self.calls, self.policy.failures), (0, 0))
+
+    def test_time_left(self):
+        self.assertEqual(store.time_left(1), 1)
+        with store.request_deadline(0.5):
+            left = self.policy.call(store.time_left, 1)
+        self.assertLessEqual(left, 0.5)
+        self.assertEqual(store.time_left(1), 1)
+
+    def test_success(self):
+        self.policy.failures = 1
+        self.assertEqual(self.policy.call(lambda: 42), 42)
+        self.assertEqual(self.policy.failures, 0)
+
+
+# @unittest.skip("Skip TestMetrics")
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.REGISTRY[:]
+
+    def tearDown(self):
+        metrics.REGISTRY[:] = self.registry
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'Test.', ('method',))
+        counter.inc(('a',))
+        counter.inc(('a',), 2)
+        counter.inc(('b"',))
+        text = metrics.render()
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{method="a"} 3', text)
+        self.assertIn('test_total{method="b\\""} 1', text)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.',
+                                      buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        with histogram.time():
+            pass
+        text = metrics.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('test_seconds_bucket{le="1"} 3', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('test_seconds_count 4', text)
+
+    def test_store_retries(self):
+        retries = store.STORE_RETRIES.values.get(('fail',), 0)
+        policy = store.RetryPolicy(attempts=3, delay=0)
+
+        def fail():
+            raise store.PoolError()
+        with self.assertRaises(store.StoreError):
+            policy.call(fail)
+        self.assertEqual(store.STORE_RETRIES.values[('fail',)], retries + 2)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+# @unittest.skip("Skip TestAsyncLog")
+class TestAsyncLog(unittest.TestCase):
+    def setUp(self):
+        self.target = ListHandler()
+        self.handler = asynclog.QueueHandler(self.target)
+        self.logger = logging.getLogger('test_asynclog')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def test_write(self):
+        self.logger.warning("%s: %s", "method", {"a": 1})
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            self.logger.exception("Unexpected error")
+        self.handler.close()
+        self.assertEqual(self.target.lines[0], "method: {'a': 1}")
+        self.assertIn("ValueError: broken", self.target.lines[1])
+
+    def test_full_queue(self):
+        handler = asynclog.QueueHandler(self.target, queue_size=1)
+        handler.writer = threading.Thread()
+        dropped = asynclog.DROPPED.values.get((), 0)
+        for _ in range(3):
+            handler.handle(self.logger.makeRecord(
+                'test', logging.INFO, __file__, 1, "message", (), None))
+        self.assertEqual(asynclog.DROPPED.values[()], dropped + 2)
+
+    def test_locks_after_fork(self):
+        # Another thread of the parent holds the locks at fork
+        locked, done = threading.Event(), threading.Event()
+
+        def hold_locks():
+            with self.handler.lock:
+                with self.target.lock:
+                    locked.set()
+                    done.wait()
+        holder = threading.Thread(target=hold_locks)
+        holder.daemon = True
+        holder.start()
+        locked.wait()
+        self.handler.pid = -1
+        self.logger.warning("child")
+        self.handler.close()
+        done.set()
+        self.assertEqual(self.target.lines, ["child"])
+
+    def test_json_lines(self):
+        self.target.setFormatter(asynclog.JsonFormatter())
+        self.logger.warning({"request_id": "42", "code": 200})
+        self.logger.warning("%s: %s", "method", "body")
+        self.handler.close()
+        first, second = [json.loads(line) for line in self.target.lines]
+        self.assertEqual(first["request_id"], "42")
+        self.assertEqual(first["level"], "WARNING")
+        self.assertEqual(second["message"], "method: body")
+
+
+# @unittest.skip("Skip TestLocalCache")
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = store.LocalCache(2)
+
+    def test_get(self):
+        self.cache.set('a', 1.5, store.time.time() + 60)
+        self.assertEqual(self.cache.get('a'), 1.5)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.stats, {
+            'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_expired(self):
+        self.cache.set('a', 1.5, store.time.time() - 1)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        self.assertEqual(self.cache.stats['size'], 0)
+
+    def test_lru(self):
+        live_till = store.time.time() + 60
+        self.cache.set('a', 1, live_till)
+        self.cache.set('b', 2, live_till)
+        self.cache.get('a')
+        self.cache.set('c', 3, live_till)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.stats['evictions'], 1)
+
+
+# @unittest.skip("Skip TestMemoryStore")
+class TestMemoryStore(unittest.TestCase):
+    def create_store(self):
+        return store.MemoryStore()
+
+    def setUp(self):
+        self.store = self.create_store()
+
+    def test_cache(self):
+        self.assertIsNone(self.store.cache_get('uid:1'))
+        self.store.cache_set('uid:1', 3.5, 60)
+        self.assertEqual(self.store.cache_get('uid:1'), 3.5)
+        self.store.cache_set('uid:2', 1.5, -1)
+        self.assertIsNone(self.store.cache_get('uid:2'))
+
+    def test_interests(self):
+        self.store.set('i:1', ['auto', 'books'])
+        self.assertEqual(self.store.get('i:1'), {'i:1': ['auto', 'books']})
+        self.assertIsNone(self.store.get('i:2'))
+        self.assertEqual(self.store.get_many(['i:1', 'i:2']),
+                         {'i:1': ['auto', 'books']})
+
+    def test_truncate(self):
+        cids = ['i:%s' % i for i in range(20)]
+        for i, cid in enumerate(cids):
+            self.store.set(cid, [str(i)])
+            self.store.cache_set('uid:%s' % i, i, 60)
+        self.store.truncate('scoring')
+        self.assertIsNone(self.store.cache_get('uid:1'))
+        self.assertEqual(len(self.store.get_many(cids)), 20)
+        self.store.truncate('interests')
+        self.assertEqual(self.store.get_many(cids), {})
+        with self.assertRaises(ValueError):
+            self.store.truncate('users')
+
+    def test_get_score(self):
+        self.assertEqual(api.get_score(self.store, '79175002040', 'a@b'), 3.0)
+        self.assertEqual(api.get_score(self.store, '', ''), 3.0)
+
+
+# @unittest.skip("Skip TestSharedMemoryStore")
+class TestSharedMemoryStore(TestMemoryStore):
+    def create_store(self):
+        return store.SharedMemoryStore(self.path, size=64)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store')
+        super(TestSharedMemoryStore, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared(self):
+        self.store.set('i:1', ['auto'])
+        self.assertEqual(self.create_store().get_many(['i:1']),
+                         {'i:1': ['auto']})
+
+    def test_full(self):
+        for i in range(200):
+            self.store.cache_set('uid:%s' % i, i, 60 + i)
+        self.assertEqual(self.store.cache_get('uid:199'), 199)
+
+    def test_too_large(self):
+        with self.assertRaises(ValueError):
+            self.store.set('i:1', ['x' * 1000])
+
+    def test_interests_are_not_evicted(self):
+        small_store = store.SharedMemoryStore(self.path + '.small', size=2)
+        small_store.cache_set('uid:1', 1.0, 60)
+        small_store.set('i:1', ['auto'])
+        small_store.set('i:2', ['books'])
+        self.assertIsNone(small_store.cache_get('uid:1'))
+        with self.assertRaises(store.TableFullError):
+            small_store.set('i:3', ['garden'])
+        small_store.cache_set('uid:2', 2.0, 60)
+        self.assertEqual(small_store.get_many(['i:1', 'i:2', 'uid:2']),
+                         {'i:1': ['auto'], 'i:2': ['books']})
+        small_store.set('i:1', ['birds'])
+        self.assertEqual(small_store.get('i:1'), {'i:1': ['birds']})
+
+
+class FakeStore(store.BaseStore):
+    def __init__(self):
+        self.data = {}
+        self.interests = {}
+        self.get_many_calls = 0
+        self.cache_calls = 0
+
+    def cache_get_many(self, keys):
+        self.cache_calls += 1
+        return super(FakeStore, self).cache_get_many(keys)
+
+    def cache_set_many(self, scores, cache_time):
+        self.cache_calls += 1
+        super(FakeStore, self).cache_set_many(scores, cache_time)
+
+    def cache_get(self, key):
+        return self.data.get(key)
+
+    def cache_set(self, key, score, cache_time):
+        self.data[key] = score
+
+    def get(self, cid):
+        return None
+
+    def get_many(self, cids):
+        self.get_many_calls += 1
+        return dict((cid, self.interests[cid]) for cid in cids
+                    if cid in self.interests)
+
+
+class SlowStore(FakeStore):
+    def __init__(self):
+        FakeStore.__init__(self)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.reads = 0
+        self.writes = 0
+
+    def cache_get(self, key):
+        self.reads += 1
+        self.started.set()
+        self.release.wait(5)
+        return FakeStore.cache_get(self, key)
+
+    def cache_set(self, key, score, cache_time):
+        self.writes += 1
+        FakeStore.cache_set(self, key, score, cache_time)
+
+
+class WorkersStore(FakeStore):
+    """Record threads which use the store, wait for two of them."""
+    def __init__(self):
+        FakeStore.__init__(self)
+        self.threads = set()
+        self.used_by_two = threading.Event()
+
+    @property
+    def is_alive(self):
+        self.threads.add(threading.current_thread())
+        if len(self.threads) >= 2:
+            self.used_by_two.set()
+        self.used_by_two.wait(2)
+        return True
+
+
+# @unittest.skip("Skip TestSingleFlight")
+class TestSingleFlight(unittest.TestCase):
+    def test_coalesced_get_score(self):
+        slow_store = SlowStore()
+        scores = []
+        coalesced = scoring.SCORE_CACHE.values.get(scoring.COALESCED, 0)
+
+        def score():
+            scores.append(scoring.get_score(
+                slow_store, '79175002040', 'a@b', first_name='a',
+                last_name='b'))
+        threads = [threading.Thread(target=score) for _ in range(5)]
+        threads[0].start()
+        slow_store.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # The other callers wait for the first one
+        deadline = time.time() + 5
+        while scoring.SCORE_CACHE.values.get(scoring.COALESCED, 0) < \
+                coalesced + 4 and time.time() < deadline:
+            time.sleep(0.001)
+        slow_store.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scores, [3.5] * 5)
+        self.assertEqual((slow_store.reads, slow_store.writes), (1, 1))
+        self.assertEqual(scoring.score_flights.flights, {})
+
+    def test_different_stores(self):
+        slow_store, fake_store = SlowStore(), FakeStore()
+        thread = threading.Thread(target=scoring.get_score, args=(
+            slow_store, '79175002040', 'a@b', None, None, 'a', 'b'))
+        thread.start()
+        slow_store.started.wait(5)
+        try:
+            self.assertEqual(scoring.get_score(
+                fake_store, '79175002040', 'a@b', first_name='a',
+                last_name='b'), 3.5)
+            self.assertEqual(len(fake_store.data), 1)
+        finally:
+            slow_store.release.set()
+            thread.join()
+
+    def test_error(self):
+        flights = scoring.SingleFlight()
+        with self.assertRaises(KeyError):
+            flights.do('key', {}.__getitem__, 'missing')
+        self.assertEqual(flights.do('key', lambda: 42), 42)
+
+
+class SmallChunkHandler(api.MainHTTPHandler):
+    chunk_size = 16
+
+
+class FewRequestsHandler(api.MainHTTPHandler):
+    max_keepalive_requests = 2
+
+
+# @unittest.skip("Skip TestPrefork")
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        probe = socket.socket()
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        self.parent = os.fork()
+        if self.parent == 0:
+            try:
+                api.serve_prefork(('localhost', port), api.MainHTTPHandler,
+                                  2, FakeStore)
+            finally:
+                os._exit(0)
+
+    def tearDown(self):
+        for pid in self.workers() | set([self.parent]):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        try:
+            os.waitpid(self.parent, 0)
+        except OSError:
+            pass
+
+    def workers(self):
+        path = '/proc/%s/task/%s/children' % (self.parent, self.parent)
+        try:
+            with open(path) as f:
+                return set(int(pid) for pid in f.read().split())
+        except IOError:
+            return set()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+    def test_restart_and_stop(self):
+        self.wait_for(lambda: len(self.workers()) == 2)
+        first = self.workers()
+        os.kill(min(first), signal.SIGKILL)
+        self.wait_for(lambda: len(self.workers()) == 2 and
+                      self.workers() != first)
+        workers = self.workers()
+        os.kill(self.parent, signal.SIGTERM)
+        self.wait_for(
+            lambda: os.waitpid(self.parent, os.WNOHANG)[0] == self.parent)
+        for pid in workers:
+            with self.assertRaises(OSError):
+                os.kill(pid, 0)
+
+
+# @unittest.skip("Skip TestPooledHTTPServer")
+class TestPooledHTTPServer(unittest.TestCase):
+    def setUp(self):
+        self.server = api.PooledHTTPServer(
+            ('localhost', 0), api.MainHTTPHandler, workers=2,
+            store_class=FakeStore)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://localhost:%s/method/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_request(self):
+        body = json.dumps({
+            "account": "horns&hoofs", "login": "h&f",
+            "method": "online_score", "token": "", "arguments": {}
+        })
+        with self.assertRaises(urllib2.HTTPError) as ctx:
+            urllib2.urlopen(self.url, body)
+        self.assertEqual(ctx.exception.code, api.FORBIDDEN)
+
+    def test_too_large(self):
+        request = urllib2.Request(self.url, 'x' * 10, {
+            'Content-Length': str(api.MainHTTPHandler.max_body_size + 1)})
+        with self.assertRaises(urllib2.HTTPError) as ctx:
+            urllib2.urlopen(request)
+        self.assertEqual(ctx.exception.code, api.REQUEST_ENTITY_TOO_LARGE)
+
+    def test_no_content_length(self):
+        connection = socket.create_connection(
+            ('localhost', self.server.server_port))
+        connection.sendall('POST /method/ HTTP/1.0\r\n\r\n{}')
+        response = connection.makefile().read()
+        connection.close()
+        self.assertIn(' 400 ', response.split('\r\n')[0])
+
+    def test_rejected_before_arguments(self):
+        self.server.RequestHandlerClass = SmallChunkHandler
+        body = ('{"account": "a", "login": "b", "token": "c", '
+                '"method": "online_score", "arguments": {"client_ids": [' +
+                '1, ' * SmallChunkHandler.chunk_size)
+        connection = socket.create_connection(
+            ('localhost', self.server.server_port))
+        connection.sendall(
+            'POST /method/ HTTP/1.0\r\nContent-Length: 100000\r\n\r\n' +
+            body)
+        response = connection.makefile().read()
+        connection.close()
+        self.assertIn(' 403 ', response.split('\r\n')[0])
+
+    def test_keepalive(self):
+        self.server.RequestHandlerClass = FewRequestsHandler
+        connection = httplib.HTTPConnection(
+            'localhost', self.server.server_port)
+        sockets = []
+        for _ in range(3):
+            connection.request('GET', '/ready/')
+            sockets.append(connection.sock)
+            response = connection.getresponse()
+            body = response.read()
+            self.assertEqual(json.loads(body)['code'], 200)
+            self.assertEqual(
+                int(response.getheader('Content-Length')), len(body))
+        connection.close()
+        self.assertIs(sockets[0], sockets[1])
+        self.assertIsNot(sockets[1], sockets[2])
+
+    def test_idle_connection_frees_worker(self):
+        server = api.PooledHTTPServer(('localhost', 0), api.MainHTTPHandler,
+                                      workers=1, store_class=FakeStore)
+        self.assertEqual(self.request_while_idle(server), 'HTTP/1.1')
+
+    def test_reset_connection(self):
+        errors = []
+        self.server.handle_error = lambda *args: errors.append(args)
+        connection = socket.create_connection(
+            ('localhost', self.server.server_port))
+        connection.sendall('GET /ready/ HTTP/1.1\r\n\r\n')
+        connection.recv(8)
+        # Closing with unread data resets the connection
+        connection.close()
+        time.sleep(0.2)
+        self.assertEqual(errors, [])
+        self.assertEqual(urllib2.urlopen(
+            self.url.replace('method', 'ready')).getcode(), api.OK)
+
+    def test_single_engine_closes_connections(self):
+        server = api.HTTPServer(('localhost', 0), api.MainHTTPHandler)
+        server.store = FakeStore()
+        self.assertEqual(self.request_while_idle(server), 'HTTP/1.0')
+
+    def request_while_idle(self, server):
+        """
+        Send a request while another connection is open and idle,
+        return the protocol of the response to the idle connection.
+        """
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            idle = socket.create_connection(
+                ('localhost', server.server_port))
+            idle.sendall('GET /ready/ HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            protocol = idle.recv(8)
+            connection = httplib.HTTPConnection(
+                'localhost', server.server_port, timeout=1)
+            connection.request('GET', '/ready/')
+            self.assertEqual(connection.getresponse().status, api.OK)
+            connection.close()
+            idle.close()
+            return protocol
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_ready(self):
+        response = urllib2.urlopen(self.url.replace('method', 'ready'))
+        self.assertEqual(json.loads(response.read()),
+                         {"code": 200, "response": {"ready": True}})
+
+    def test_metrics(self):
+        urllib2.urlopen(self.url.replace('method', 'ready')).read()
+        response = urllib2.urlopen(self.url.replace('method', 'metrics'))
+        self.assertTrue(
+            response.info().getheader('Content-Type').startswith(
+                'text/plain'))
+        self.assertIn('http_requests_total{method="ready",code="200"}',
+                      response.read())
+
+    def test_shared_store(self):
+        server = api.PooledHTTPServer(('localhost', 0), api.MainHTTPHandler,
+                                      workers=2, store_class=WorkersStore)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://localhost:%s/ready/' % server.server_port
+        try:
+            # Both requests are in is_alive at once, so two workers
+            # serve them
+            clients = [threading.Thread(target=urllib2.urlopen, args=(url,))
+                       for _ in range(2)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            self.assertEqual(len(server.store.threads), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
 if __name__ == "__main__":
     unittest.main()